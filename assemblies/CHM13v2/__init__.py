@@ -15,6 +15,8 @@ fasta = ROOT / "CHM13v2.fa.gz"
 # RepeatMasker
 repcls = RepmaskerClassification(ROOT / "repmasker.CHM13v2.classification.tsv.gz")
 repmasker = ROOT / "repmasker.CHM13v2.bed.gz"
+repmasker_index = ROOT / "repmasker.CHM13v2.npz"  # utils.repmasker.RepeatIndex
 
 # REDI portal
 rediportal = ROOT / "rediportal.CHM13v2.bed.gz"
+rediportal_index = ROOT / "rediportal.CHM13v2.npz"  # utils.sites.SiteIndex
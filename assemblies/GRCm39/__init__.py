@@ -15,6 +15,8 @@ fasta = ROOT / "GRCm39.primary_assembly.genome.fa.gz"
 # RepeatMasker
 repcls = RepmaskerClassification(ROOT / "repmasker.GRCm39.classification.tsv.gz")
 repmasker = ROOT / "repmasker.GRCm39.bed.gz"
+repmasker_index = ROOT / "repmasker.GRCm39.npz"  # utils.repmasker.RepeatIndex
 
 # REDI portal
 rediportal = ROOT / "rediportal.GRCm39.bed.gz"
+rediportal_index = ROOT / "rediportal.GRCm39.npz"  # utils.sites.SiteIndex
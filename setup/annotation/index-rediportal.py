@@ -0,0 +1,8 @@
+import utils
+from assemblies import GRCm39, CHM13v2
+
+# Binary position index of REDIportal sites
+for assembly in GRCm39, CHM13v2:
+    index = utils.sites.SiteIndex.build([assembly.rediportal], assembly.rediportal_index)
+    total = sum(len(x) for x in index._positions.values())
+    print(f"[{assembly.name}] Indexed {total} REDIportal sites")
@@ -0,0 +1,7 @@
+import utils
+from assemblies import GRCm39, CHM13v2
+
+# Persistent RepeatMasker index
+for assembly in GRCm39, CHM13v2:
+    index = utils.repmasker.RepeatIndex.build(assembly.repmasker, assembly.repmasker_index)
+    print(f"[{assembly.name}] Indexed {len(index.starts)} repeats ({len(index.names)} names)")
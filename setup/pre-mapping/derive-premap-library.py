@@ -99,7 +99,7 @@ for assembly in GRCm39, CHM13v2:
     # Sequences that are inside the assembly are saved as BED intervals (even if they were 'optimized' away).
     # Outside optimized sequences are saved as BED intervals too and also written to a FASTA file.
 
-    bed, outside = [], []
+    records, outside = [], []
     included = set()
 
     # First pass: collect all sequences that are inside the assembly
@@ -107,7 +107,7 @@ for assembly in GRCm39, CHM13v2:
         if name.startswith(assembly.name):
             interval = inside_assembly[name]
             # Intentionally drop the strand information
-            bed.append(Interval(interval.chrom, interval.start, interval.end))
+            records.append(Interval(interval.chrom, interval.start, interval.end))
             included.add(name)
 
     # Second pass: collect all sequences that are outside the assembly
@@ -116,13 +116,13 @@ for assembly in GRCm39, CHM13v2:
             continue
         assert not name.startswith(assembly.name)
         outside.append((name, seq))
-        bed.append(Interval(name, 0, len(seq)))
+        records.append(Interval(name, 0, len(seq)))
 
     saveto = RESULTS / assembly.name
     saveto.mkdir(exist_ok=True)
 
     # Write RNA intervals to BED file
-    BedTool(bed).sort().merge().sort().saveas(saveto / "pre-mapping.bed.gz")
+    bed.tbindex(BedTool(records).sort().merge().sort(), saveto / "pre-mapping.bed.gz")
 
     # Write pre-mapping sequences to FASTA file
     with gzip.open(saveto / "pre-mapping.fa.gz", 'wt') as stream:
@@ -82,6 +82,7 @@ def job(assembly):
     saveto.parent.mkdir(parents=True, exist_ok=True)
 
     utils.bed.tbindex(pybedtools.BedTool(bed).sort(), saveto)
+    utils.sites.SiteIndex.build([saveto], saveto.with_suffix("").with_suffix(".npz"))
 
     # 6. Filter REAT tables / Save individual tracks
     def filter(sample: Path, saveto: Path, trackto: Path):
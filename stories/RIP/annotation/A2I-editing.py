@@ -1,55 +1,37 @@
-import gzip
 import pickle
-from collections import defaultdict
 
-from biobit.core.loc import Orientation
-from intervaltree import intervaltree
+from biobit.core.loc import Interval
 from joblib import Parallel, delayed
 from tqdm import tqdm
 
+import utils
 from stories import A2I
 from stories.RIP import annotation
 
-
-# Load and index editing sites
-def index_editing_sites(assembly: str) -> dict[tuple[str, Orientation], intervaltree.IntervalTree]:
-    bed = A2I.tracks.all_passed / f"{assembly}.bed.gz"
-
-    sites = defaultdict(intervaltree.IntervalTree)
-    with gzip.open(bed, 'rt') as stream:
-        for line in stream:
-            seqid, start, end, _, _, strand = line.strip().split('\t')
-            sites[seqid, Orientation(strand)].addi(int(start), int(end))
-    return dict(sites)
-
-
-EDITING_SITES = {assembly: index_editing_sites(assembly) for assembly in ["CHM13v2", "GRCm39"]}
+# Binary position index of editing sites (see A2I/candidates-filtering.py)
+EDITING_SITES = {
+    assembly: utils.sites.SiteIndex(A2I.tracks.all_passed / f"{assembly}.npz") for assembly in ["CHM13v2", "GRCm39"]
+}
 
 
 def job(config: annotation.Config):
     assembly = {x.assembly for x in config.comparisons}
     assert len(assembly) == 1, assembly
 
-    all_esites = EDITING_SITES[assembly.pop()]
+    esites = EDITING_SITES[assembly.pop()]
 
     results = {}
     for partition in tqdm(config.elements):
-        if (partition.contig, partition.orientation) not in all_esites:
-            results[partition.ind] = 0
-            continue
-
-        esites = all_esites[partition.contig, partition.orientation]
-        overlap = set()
-
-        # Calculate scores for individual peaks
-        for peak in partition.peaks:
-            overlap |= esites.overlap(peak.start, peak.end)
-
+        # Peaks and dsRNA arms are merged to count each site only once
+        ranges = [Interval(peak.start, peak.end) for peak in partition.peaks]
         for invrep in partition.invrep:
-            for seqrng in invrep.seqranges():
-                overlap |= esites.overlap(seqrng.start, seqrng.end)
+            ranges.extend(Interval(x.start, x.end) for x in invrep.seqranges())
+        ranges = Interval.merge(ranges)
 
-        results[partition.ind] = len(overlap)
+        counts = esites.count(
+            partition.contig, partition.orientation.symbol(), [x.start for x in ranges], [x.end for x in ranges]
+        )
+        results[partition.ind] = int(counts.sum())
 
     config.a2i.parent.mkdir(parents=True, exist_ok=True)
     with open(config.a2i, 'wb') as stream:
@@ -14,7 +14,7 @@ POOL = Parallel(n_jobs=-1, verbose=100)
 def job(cmp: pcalling.Config, seqid: str, strand: Orientation, segments: list[Interval]):
     seqsize = utils.assembly.seqsizes(cmp.organism)[seqid]
     tracks = clustering.invrep_scoring.ExperimentTracks(cmp) \
-        .open(seqid, seqsize, strand.to_strand())
+        .open(seqid, seqsize, strand.to_strand(), regions=list(segments))
 
     scores = {}
     for segment in segments:
@@ -0,0 +1,27 @@
+import random
+import time
+
+import utils
+
+# Synthetic dense strand: 100k peaks, 10k insulators and 1k connectors over 200Mb
+random.seed(42)
+SEQID, LENGTH = "chr1", 200_000_000
+
+
+def synthetic(n: int, minlen: int, maxlen: int) -> list[tuple[str, tuple[int, int], str]]:
+    result = []
+    for _ in range(n):
+        start = random.randint(0, LENGTH - maxlen)
+        result.append((SEQID, (start, start + random.randint(minlen, maxlen)), "+"))
+    return result
+
+
+peaks = synthetic(100_000, 36, 500)
+insulators = synthetic(10_000, 100, 5_000)
+connectors = synthetic(1_000, 100, 1_000)
+
+for maxdist in 1_000, 15_000, 50_000:
+    start = time.perf_counter()
+    groups = utils.repeto.group(peaks, insulators, connectors, maxdist=maxdist)
+    elapsed = time.perf_counter() - start
+    print(f"maxdist={maxdist}: {len(groups)} groups in {elapsed:.2f}s")
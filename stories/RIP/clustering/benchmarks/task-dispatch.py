@@ -0,0 +1,48 @@
+import time
+
+import numpy as np
+from intervaltree import IntervalTree
+from joblib import Parallel, delayed, cpu_count
+
+import utils
+
+# Dispatch overhead of the clustering/filtering pools: per-contig peaks pickled into every task (IntervalTree, as before)
+# vs. handles to the shared data plane. The job itself is trivial to expose the serialization cost.
+CONTIGS, PEAKS, REPEATS = 24, 100_000, 4
+
+rng = np.random.default_rng(42)
+data = {}
+for contig in range(CONTIGS):
+    start = np.sort(rng.integers(0, 200_000_000, PEAKS))
+    data[contig] = (start, start + rng.integers(36, 500, PEAKS))
+
+
+def job_itree(peaks: IntervalTree) -> int:
+    return len(peaks.overlap(1_000_000, 2_000_000))
+
+
+def job_handle(peaks: utils.shared.Handle) -> int:
+    peaks = peaks.load()
+    lo, hi = np.searchsorted(peaks['start'], [1_000_000 - 500, 2_000_000])
+    return int(np.count_nonzero(peaks['end'][lo:hi] > 1_000_000))
+
+
+pool = Parallel(n_jobs=max(2, cpu_count()))
+pool(delayed(int)(x) for x in range(128))  # Warm-up workers
+
+itrees = {contig: IntervalTree.from_tuples(zip(start.tolist(), end.tolist())) for contig, (start, end) in data.items()}
+start = time.perf_counter()
+before = pool(delayed(job_itree)(itrees[contig]) for _ in range(REPEATS) for contig in data)
+print(f"Pickled IntervalTrees: {time.perf_counter() - start:.2f}s for {REPEATS * CONTIGS} tasks")
+
+with utils.shared.Plane() as plane:
+    start = time.perf_counter()
+    handles = {contig: plane.publish(start=s, end=e) for contig, (s, e) in data.items()}
+    published = time.perf_counter() - start
+
+    start = time.perf_counter()
+    after = pool(delayed(job_handle)(handles[contig]) for _ in range(REPEATS) for contig in data)
+    print(f"Shared data plane: {time.perf_counter() - start:.2f}s for {REPEATS * CONTIGS} tasks "
+          f"(+{published:.2f}s to publish)")
+
+assert before == after
@@ -1,15 +1,13 @@
 import pickle
-from bisect import bisect_left
 from collections import defaultdict
+from dataclasses import fields
 from itertools import chain
 
-import numpy as np
-import rustworkx
 from biobit.core.loc import Interval, Orientation, Strand
 from biobit.toolkit.repeto.repeats import InvRepeat
 from intervaltree import IntervalTree
 from joblib import Parallel, delayed
-from pybedtools import BedTool, Interval as BedInterval
+from pybedtools import BedTool
 
 import ld
 import utils
@@ -19,9 +17,16 @@ POOL = Parallel(n_jobs=-1, verbose=100)
 
 
 def group_all(
-        contig: str, strand: Strand, dsRNA: list[InvRepeat], peaks: list[Interval],
-        transcripts: IntervalTree | None, curated: IntervalTree | None, insulators: list[int] | None, max_distance: int
+        contig: str, strand: Strand, dsRNA: utils.repeto.InvRepeatView | None, peaks: utils.shared.Handle,
+        transcripts: utils.shared.Handle | None, curated: IntervalTree | None, insulators: list[int] | None,
+        max_distance: int
 ) -> tuple[str, Strand, list[list[InvRepeat | Interval]]]:
+    # Materialize inputs from the shared data plane
+    dsRNA = list(dsRNA) if dsRNA is not None else []
+    peaks = peaks.load()
+    peaks = [Interval(start, end) for start, end in zip(peaks['start'].tolist(), peaks['end'].tolist())]
+    transcripts = ld.transcripta.ExonIndex(**transcripts.load()) if transcripts is not None else None
+
     # Keep only dsRNAs that overlap with peaks
     index = IntervalTree.from_tuples([(x.start, x.end) for x in peaks])
     dsRNA = [x for x in dsRNA
@@ -75,65 +80,13 @@ def group_all(
             all_elements.append((len(index), block))
         index.append(rna)
 
-    # Derive all possible connections
-    connections = np.zeros((len(index), len(index)), dtype=bool)
-
-    # * Elements that are close in genomic coordinates
-    all_elements = sorted(all_elements, key=lambda x: x[1].start)
-    insulators = sorted(set(insulators)) if insulators is not None else []
-    closest_insulator = [bisect_left(insulators, x[1].start) for x in all_elements]
-    for first in range(len(all_elements)):
-        find, felement = all_elements[first]
-        finsulator = bisect_left(insulators, felement.end)
-        for second in range(first + 1, len(all_elements)):
-            sind, selement = all_elements[second]
-            sinsulator = closest_insulator[second]
-            if selement.start - felement.end <= max_distance:
-                # Only connect if they are in the same insulated region
-                connections[find, sind] = sinsulator == finsulator
-            else:
-                break
-
-    # * Elements that are close in transcriptomic coordinates
-    if transcripts is not None:
-        rna_overlap = defaultdict(list)
-        for ind, element in all_elements:
-            for rna in transcripts.overlap(element.start, element.end):
-                rna_overlap[rna.data].append((ind, element))
-
-        for rna, overlaps in rna_overlap.items():
-            mapped = []
-            for ind, element in overlaps:
-                if rna.map(element) is not None:
-                    mapped.append((ind, element))
-
-            mapped = list({x[0] for x in mapped})
-            for first in range(len(mapped)):
-                find = mapped[first]
-                for second in range(first + 1, len(mapped)):
-                    sind = mapped[second]
-                    connections[find, sind] = True
-
-        # mapped = sorted(mapped, key=lambda x: x[1].start)
-        # for first in range(len(mapped)):
-        #     find, felement = mapped[first]
-        #     for second in range(first + 1, len(mapped)):
-        #         sind, selement = mapped[second]
-        #         if selement.start - felement.end <= max_distance:
-        #             connections[find, sind] = True
-        #         else:
-        #             break
+    # Elements that are close in transcriptomic coordinates (mapped to exons of the same transcript)
+    links = transcripts.links(all_elements) if transcripts is not None else []
 
     # Each node is a single element, each edge is a connection denoting that two elements are part of the same partition
     # We need to find all connected components in this graph - each connected component is a partition
-    print(f"[{contig}:{strand}]Connections: {len(connections)}")
-    graph = rustworkx.PyGraph(node_count_hint=len(index), edge_count_hint=len(connections))
-    graph.add_nodes_from(range(len(index)))
-    graph.add_edges_from_no_data([
-        (find, sind) for find in range(len(index)) for sind in range(len(index)) if connections[find, sind]
-    ])
-
-    components = rustworkx.connected_components(graph)
+    components = utils.repeto.components(len(index), all_elements, max_distance, insulators, links)
+    print(f"[{contig}:{strand}]Components: {len(components)}")
     groups.extend([[index[ind] for ind in component] for component in components])
     return contig, strand, groups
 
@@ -155,11 +108,7 @@ def posprocess_groups(
     if peaks and dsRNA:
         peaks = sorted(peaks, key=lambda x: x.start)
         blocks = chain(*[[x.left_brange(), x.right_brange()] for x in dsRNA])
-        blocks = sorted(blocks, key=lambda x: x.start)
-        nonredundant = BedTool([BedInterval(contig, p.start, p.end) for p in peaks]) \
-            .subtract(BedTool([BedInterval(contig, rna.start, rna.end) for rna in blocks]))
-
-        peaks = [Interval(x.start, x.end) for x in nonredundant]
+        peaks = utils.bed.subtract(peaks, blocks)
 
     return contig, strand.to_orientation(), dsRNA, peaks
 
@@ -175,8 +124,7 @@ for config in ld.Config.load():
     peaks = {(contig, Strand(strand)): p for (contig, strand), p in peaks.items()}
 
     # Load dsRNAs and select only those overlapping with peaks
-    with open(config.dsRNA.filtered, 'rb') as stream:
-        dsRNA = pickle.load(stream)
+    dsRNA = utils.repeto.InvRepeatStore(config.dsRNA.filtered_store)
 
     # Load curated groups
     curated = defaultdict(lambda: IntervalTree())
@@ -194,14 +142,23 @@ for config in ld.Config.load():
     host = utils.assembly.get(organism=config.host)
     transcripts = ld.transcripta.parse(host)
 
-    pre_groups = POOL(
-        delayed(group_all)(
-            seqid, stnd, dsRNA.get((seqid, stnd), []), peaks.get((seqid, stnd), []),
-            transcripts.get((seqid, stnd)), curated.get(seqid), insulators.get((seqid, stnd)),
-            config.clusters.max_distance
+    # Workers receive handles: dsRNAs are memory-mapped from the store, peaks/transcripts from the shared data plane
+    with utils.shared.Plane() as plane:
+        peaks = {
+            key: plane.publish(start=[x.start for x in p], end=[x.end for x in p]) for key, p in peaks.items()
+        }
+        transcripts = {
+            key: plane.publish(**{x.name: getattr(index, x.name) for x in fields(index)})
+            for key, index in transcripts.items()
+        }
+        pre_groups = POOL(
+            delayed(group_all)(
+                seqid, stnd, dsRNA.get((seqid, stnd)), peaks[seqid, stnd],
+                transcripts.get((seqid, stnd)), curated.get(seqid), insulators.get((seqid, stnd)),
+                config.clusters.max_distance
+            )
+            for seqid, stnd in peaks.keys()
         )
-        for seqid, stnd in peaks.keys()
-    )
     pre_groups = POOL(
         delayed(posprocess_groups)(contig, strand, g)
         for contig, strand, groups in pre_groups
@@ -1,24 +1,84 @@
+import hashlib
+import os
 import pickle
 import tempfile
-from collections import defaultdict
+from collections import Counter
+from collections.abc import Iterator
+from importlib.metadata import version
 from itertools import batched
 from multiprocessing import cpu_count
+from pathlib import Path
 from typing import Any
 
 import pybedtools
 from biobit.core.loc import Orientation
 from biobit.toolkit import repeto
-from joblib import Parallel, delayed, Memory
 from pybedtools import BedTool
 
 import ld
+import utils.bed
 import utils.repeto
 
+# Resources available for repeto predictions, overridable via REPETO_RAM_BUDGET (GB) and REPETO_CPU_BUDGET
+RAM_BUDGET = int(float(os.environ.get("REPETO_RAM_BUDGET", 0)) * 1024 ** 3) or \
+             int(0.9 * os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES'))
+CPU_BUDGET = int(os.environ.get("REPETO_CPU_BUDGET", 0)) or cpu_count()
+
+# Peak memory model for repeto.predict.run: BASE + PER_CELL * length^2, where length = bsegment + 2 * offset.
+# The constants below are uncalibrated priors. Once <dsRNA cache>/peak-rss.tsv holds enough per-task VmHWM
+# measurements, the coefficients are refitted from it (ld.scheduler.fit_memory) and printed for each config.
+MEMORY_BASE = 512 * 1024 ** 2
+MEMORY_PER_CELL = 4.0
+
+# Seed prefilter (opt-in): skip groups without reverse-complement k-mer hits between the ROIs and the window.
+# A fraction of pruned groups (selected by the cache key) is still predicted to monitor the prefilter recall.
+# Keep it disabled until a run with SEED_RECALL_CHECK = 1.0 reports no missed predictions.
+SEED_PRUNE = False
+SEED = 12
+SEED_RECALL_CHECK = 0.01
+
+# Groups with a shorter bsegment are processed in batches to reduce the number of tasks
+SMALL_GROUP = 50_000
+SMALL_BATCH = 64
+
+
+def seqlen(group: utils.repeto.RepetoGroup, config: ld.Config) -> int:
+    return group.bsegment.len() + 2 * config.dsRNA.offset
+
+
+def estimate_memory(length: int, model: tuple[float, float]) -> int:
+    base, per_cell = model
+    return int(base + per_cell * length ** 2)
+
+
+# Everything that affects the predictions beside the sequence and ROIs
+def predict_params(config: ld.Config) -> dict[str, Any]:
+    return {
+        "min_score": config.dsRNA.min_score,
+        "min_matches": (config.dsRNA.min_length, 1),
+        "min_roi_overlap": (config.dsRNA.min_roi_overlap, 1),
+        "scoring": "default",
+        "biobit": version("biobit"),
+    }
+
+
+# Batch identifier for the checkpoints: groups, sequence windows and prediction settings
+def batch_id(batch: tuple[utils.repeto.RepetoGroup, ...], config: ld.Config) -> str:
+    digest = hashlib.sha256(repr((
+        config.host, config.dsRNA.offset, SEED_PRUNE, SEED, SEED_RECALL_CHECK, sorted(predict_params(config).items())
+    )).encode())
+    for group in batch:
+        key = (group.contig, str(group.orientation), group.bsegment.start, group.bsegment.end)
+        digest.update(repr((key, [(x.start, x.end) for x in group.rois])).encode())
+    return digest.hexdigest()
+
 
 # Run repeto to predict putative dsRNAs
-def job(_: Any, batch: tuple[utils.repeto.RepetoGroup, ...], config: ld.Config):
-    results = []
+def job(batch: tuple[utils.repeto.RepetoGroup, ...], config: ld.Config):
+    results, stats = [], Counter()
     contigs = utils.assembly.get(organism=config.host).seqid.sizes()
+    cache = utils.repeto.PredictionCache(ld.REPETO_CACHE)
+    params = predict_params(config)
 
     for group in batch:
         if sum(x.len() for x in group.rois) < config.dsRNA.min_roi_overlap:
@@ -39,15 +99,35 @@ def job(_: Any, batch: tuple[utils.repeto.RepetoGroup, ...], config: ld.Config):
         if group.orientation == Orientation.Reverse:
             seq = seq[::-1]
 
-        # Predict all possible fold-back dsRNAs overlapping the peaks
+        # Predict all possible fold-back dsRNAs overlapping the peaks (or reuse results for the identical query)
+        seq = seq.encode("ASCII")
         rois = [(r.start - start, r.end - start) for r in group.rois]
-        filt = repeto.predict.Filter() \
-            .set_min_score(config.dsRNA.min_score) \
-            .set_min_matches(config.dsRNA.min_length, 1) \
-            .set_min_roi_overlap(config.dsRNA.min_roi_overlap, 1) \
-            .set_rois(rois)
+        key = utils.repeto.PredictionCache.key(seq, rois, params)
 
-        irs, scores = repeto.predict.run(seq.encode("ASCII"), filt, repeto.predict.Scoring())
+        # The prefilter is applied before the cache lookup, i.e. the results don't depend on the cache content
+        checked = False
+        if SEED_PRUNE and not utils.repeto.has_seeds(seq, rois, SEED):
+            if int(key[:8], 16) >= SEED_RECALL_CHECK * 16 ** 8:
+                stats['pruned'] += 1
+                results.append((group, [], []))
+                continue
+            checked = True
+
+        if (cached := cache.get(key)) is not None:
+            irs, scores = cached
+        else:
+            filt = repeto.predict.Filter() \
+                .set_min_score(config.dsRNA.min_score) \
+                .set_min_matches(config.dsRNA.min_length, 1) \
+                .set_min_roi_overlap(config.dsRNA.min_roi_overlap, 1) \
+                .set_rois(rois)
+
+            irs, scores = repeto.predict.run(seq, filt, repeto.predict.Scoring())
+            cache.put(key, irs, scores)
+
+        if checked:
+            stats['checked'] += 1
+            stats['missed'] += len(irs) > 0
 
         # Map coordinates back to the genome
         for ir in irs:
@@ -56,7 +136,37 @@ def job(_: Any, batch: tuple[utils.repeto.RepetoGroup, ...], config: ld.Config):
         # print(f"{group.contig}:{start}-{end} [{group.orientation}] -> {len(irs)}")
         results.append((group, irs, scores))
 
-    return results
+    return results, stats
+
+
+# Drop duplicated BED lines, identical lines are adjacent once sorted by (contig, start)
+def unique(bed: BedTool) -> Iterator[pybedtools.Interval]:
+    contig, start, lines = None, None, set()
+    for it in bed:
+        if (it.chrom, it.start) != (contig, start):
+            contig, start, lines = it.chrom, it.start, set()
+        line = str(it)
+        if line not in lines:
+            lines.add(line)
+            yield it
+
+
+# Predict a batch and save it as a shard, the manifest lists completed shards
+def checkpointed(batch: tuple[utils.repeto.RepetoGroup, ...], config: ld.Config, shard: Path) -> Counter:
+    results, stats = job(batch, config)
+
+    fd, tmp = tempfile.mkstemp(dir=shard.parent, suffix=".tmp")
+    with os.fdopen(fd, 'wb') as stream:
+        pickle.dump((results, stats), stream, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp, shard)
+
+    # Single O_APPEND write - safe for concurrent workers
+    manifest = os.open(shard.parent / "manifest.tsv", os.O_WRONLY | os.O_APPEND | os.O_CREAT)
+    try:
+        os.write(manifest, f"{shard.stem}\t{len(batch)}\n".encode())
+    finally:
+        os.close(manifest)
+    return stats
 
 
 with open(ld.INSULATORS_CACHE, 'rb') as stream:
@@ -65,8 +175,6 @@ with open(ld.INSULATORS_CACHE, 'rb') as stream:
 for config in ld.Config.load():
     print(f"Processing {config.ind}")
     config.dsRNA.cache.mkdir(parents=True, exist_ok=True)
-    memory = Memory(location=config.dsRNA.cache, verbose=0)
-    cached = memory.cache(job, ignore=['batch', 'config'], verbose=False)
 
     # Group all prefiltered peaks for dsRNA prediction
     allpeaks = [(p.chrom, (p.start, p.end), p.strand) for p in BedTool(config.peaks.prefiltered)]
@@ -85,9 +193,9 @@ for config in ld.Config.load():
 
     # Save derived repeto groups (for visualization & debug)
     bed = [pybedtools.Interval(x.contig, x.bsegment.start, x.bsegment.end, strand=str(x.orientation)) for x in groups]
-    BedTool(bed).sort().saveas(config.dsRNA.repeto)
+    utils.bed.tbindex(BedTool(bed).sort(), config.dsRNA.repeto)
 
-    # Sort is required to guarantee reproducibility of the hashing
+    # Sort to make the batches (and the outputs) reproducible
     groups = sorted(groups, key=lambda x: (x.bsegment.len(), x.contig, x.orientation, x.bsegment, x.rois))
     print(f'Total targets: {len(groups)}')
 
@@ -97,49 +205,72 @@ for config in ld.Config.load():
         print(f"\t{p.contig}:{p.bsegment}\t{p.bsegment.len()}\tN={len(p.rois)}")
     total = len(groups)
 
-    # Assuming that there are 1.5TB RAM and 96 cores available
-    allresults = []
-    for minlen, maxlen, cores, n in [
-        (0, 50_000, 96, 64),
-        (50_000, 75_000, 48, 1),
-        (75_000, 100_000, 32, 1),
-        (100_000, float("inf"), 12, 1),
-    ]:
-        selected, left = [], []
-        for group in groups:
-            if minlen <= group.bsegment.len() < maxlen:
-                key = (config.ind, group.contig, group.orientation,
-                       group.bsegment.start, group.bsegment.end, len(group.rois))
-                selected.append((key, group))
-            else:
-                left.append(group)
-        groups = left
-
-        print(f"Batch length: {len(selected)}")
-        selected = sorted(selected, key=lambda x: x[0])
-
-        batch = Parallel(verbose=100, n_jobs=min(cpu_count(), cores), batch_size=1)(
-            delayed(cached)(tuple(sorted(x[0] for x in batch)), tuple(x[1] for x in batch), config)
-            for batch in batched(selected, n=n)
-        )
-        allresults.extend((group, irs, scores) for b in batch for group, irs, scores in b)
-
-    if total != len(allresults):
-        print(f"Expected {total} groups, got {len(allresults)}")
-    # assert len(allresults) == len(groups)
-
-    # Save all predicted dsRNA as BED/pkl
-    track, pkl = set(), defaultdict(list)
-    for group, irs, scores in allresults:
-        pkl[(group.contig, group.orientation)].append((group, irs))
-        for ir, score in zip(irs, scores):
-            track.add(ir.to_bed12(contig=group.contig, strand=str(group.orientation), name=str(score)) + "\n")
-
-    config.dsRNA.predicted.parent.mkdir(parents=True, exist_ok=True)
-    with open(config.dsRNA.predicted, 'wb') as stream:
-        pickle.dump(pkl, stream, protocol=pickle.HIGHEST_PROTOCOL)
+    # Small groups are batched, the rest are processed one by one
+    small, large = [], []
+    for group in groups:
+        (small if group.bsegment.len() < SMALL_GROUP else large).append(group)
+    batches = list(batched(small, n=SMALL_BATCH)) + [(x,) for x in large]
+
+    # Skip batches completed by previous runs
+    shards = config.dsRNA.cache / "shards"
+    shards.mkdir(parents=True, exist_ok=True)
+    completed = set()
+    if (shards / "manifest.tsv").exists():
+        with open(shards / "manifest.tsv") as stream:
+            completed = {line.split("\t")[0] for line in stream}
+
+    # Memory model: fitted to the peak RSS of previous runs or the default priors
+    model = ld.scheduler.fit_memory(config.dsRNA.cache / "peak-rss.tsv") or (MEMORY_BASE, MEMORY_PER_CELL)
+    print(f"Memory model: {model[0] / 1024 ** 2:.0f}MB + {model[1]:.3f}B * length^2")
+
+    tasks, ids = [], [batch_id(batch, config) for batch in batches]
+    for ind, batch in zip(ids, batches):
+        if ind in completed and (shards / f"{ind}.pkl").exists():
+            continue
+        length = max(seqlen(x, config) for x in batch)
+        head = batch[0]
+        tag = f"{head.contig}:{head.bsegment.start}-{head.bsegment.end}[{head.orientation}]x{len(batch)}"
+        tasks.append(ld.scheduler.Task(
+            tag, length, estimate_memory(length, model), checkpointed, (batch, config, shards / f"{ind}.pkl")
+        ))
+    print(f"Tasks: {len(tasks)} (completed: {len(batches) - len(tasks)}), "
+          f"RAM budget: {RAM_BUDGET / 1024 ** 3:.1f}GB, CPU budget: {CPU_BUDGET}")
+
+    ld.scheduler.run(tasks, RAM_BUDGET, CPU_BUDGET, log=config.dsRNA.cache / "peak-rss.tsv")
+
+    # Count the InvRepeats/segments per contig/orientation to lay out the columnar store
+    processed, stats, layout = 0, Counter(), {}
+    for ind in ids:
+        with open(shards / f"{ind}.pkl", 'rb') as stream:
+            results, shard_stats = pickle.load(stream)
+        stats += shard_stats
+
+        for group, irs, _ in results:
+            processed += 1
+            count, segments = layout.get((group.contig, group.orientation), (0, 0))
+            layout[group.contig, group.orientation] = (count + len(irs), segments + sum(len(x.segments) for x in irs))
+        del results
 
+    print(f"Seed prefilter: pruned {stats['pruned']} / {total} groups; "
+          f"recall check: {stats['missed']} / {stats['checked']} pruned groups had predicted dsRNAs")
+
+    if total != processed:
+        print(f"Expected {total} groups, got {processed}")
+
+    # Stream shards one by one into the columnar store and the BED track
     with tempfile.NamedTemporaryFile() as tmp:
-        with open(tmp.name, 'w') as stream:
-            stream.writelines(track)
-        utils.bed.tbindex(BedTool(tmp.name).sort(), config.dsRNA.predicted.with_suffix(".bed.gz"))
+        with open(tmp.name, 'w') as track:
+            def chunks():
+                for ind in ids:
+                    with open(shards / f"{ind}.pkl", 'rb') as stream:
+                        results, _ = pickle.load(stream)
+                    for group, irs, scores in results:
+                        for ir, score in zip(irs, scores):
+                            track.write(
+                                ir.to_bed12(contig=group.contig, strand=str(group.orientation), name=str(score)) + "\n"
+                            )
+                        yield (group.contig, group.orientation), utils.repeto.InvRepeatView.from_invrep(irs, scores)
+
+            utils.repeto.InvRepeatStore.stream(config.dsRNA.predicted_store, layout, chunks())
+
+        utils.bed.tbindex(BedTool(unique(BedTool(tmp.name).sort())), config.dsRNA.predicted.with_suffix(".bed.gz"))
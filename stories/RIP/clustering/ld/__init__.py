@@ -1,14 +1,16 @@
 from pathlib import Path
 
-from . import features, invrep_scoring, transcripta
+from . import features, invrep_scoring, scheduler, transcripta, universe
 from .config import Config, PeaksConfig, dsRNAConfig, ClusteringConfig
 
 ROOT = Path(__file__).parent
 RESULTS = ROOT / "results"
 
 INSULATORS_CACHE = ROOT / "insulators.pkl"
+# Content-addressed repeto predictions shared by all configs
+REPETO_CACHE = RESULTS / "repeto-cache"
 
 __all__ = [
-    "features", "invrep_scoring", "transcripta", "RESULTS",
+    "features", "invrep_scoring", "scheduler", "transcripta", "universe", "RESULTS",
     "Config", "PeaksConfig", "dsRNAConfig", "ClusteringConfig"
 ]
@@ -49,7 +49,9 @@ class dsRNAConfig:
     repeto: Path = field(init=False)  # Peak groups for repeto
     cache: Path = field(init=False)  # Repeto cache
     predicted: Path = field(init=False)  # All predicted dsRNA
+    predicted_store: Path = field(init=False)  # Columnar store of all predicted dsRNA
     filtered: Path = field(init=False)  # All dsRNAs passing the filtering
+    filtered_store: Path = field(init=False)  # Columnar store of all dsRNAs passing the filtering
     insulators: Path = field(init=False)  # Curated insulators
 
 
@@ -101,7 +103,9 @@ class Config:
         object.__setattr__(self.dsRNA, "repeto", self.root / "dsRNA" / "repeto.bed.gz")
         object.__setattr__(self.dsRNA, "cache", self.root / "dsRNA" / "cache")
         object.__setattr__(self.dsRNA, "predicted", self.root / "dsRNA" / "predicted.pkl")
+        object.__setattr__(self.dsRNA, "predicted_store", self.root / "dsRNA" / "predicted")
         object.__setattr__(self.dsRNA, "filtered", self.root / "dsRNA" / "filtered.pkl")
+        object.__setattr__(self.dsRNA, "filtered_store", self.root / "dsRNA" / "filtered")
         object.__setattr__(self.dsRNA, "insulators", self.root / "curated" / "insulators.bed")
         # Clusters
         object.__setattr__(self.clusters, "curated", self.root / "curated" / "clusters.bed")
@@ -1,226 +1,268 @@
-import pickle
 from collections import defaultdict
-from typing import Any, Literal
+from collections.abc import Iterator
+from pathlib import Path
+from typing import Literal
 
 import intervaltree
+import numpy as np
 import pandas as pd
-import pybedtools
 from biobit.core.loc import Interval, Orientation
-from biobit.toolkit import countit
 from biobit.toolkit.repeto.repeats import InvRepeat
-from intervaltree import IntervalTree
 from joblib import Parallel, delayed
 from pybedtools import BedTool
 
 import utils
 from stories import annotation, A2I
-from stories.RIP.clustering.ld import config as clustering
+from stories.RIP.clustering.ld import config as clustering, universe
 
 BED_DTYPES = {0: str, 1: int, 2: int, 3: str, 4: str, 5: str}
 
 
-def build_universe(config: clustering.Config) -> pd.DataFrame:
-    def load_peaks(cmp: clustering.pcalling.Config):
-        segments = defaultdict(list)
-        for p in pybedtools.BedTool(cmp.reaper.filtered_peaks):
-            segments[p.chrom, p.strand].append(Interval(p.start, p.end))
-        segments = {(contig, Orientation(strand)): sgs for (contig, strand), sgs in segments.items()}
-        return cmp.ind, segments
+def update_universe(config: clustering.Config) -> bool:
+    # Build the universe or extend it with comparisons missing from the saved bitsets. True if it was (re)saved.
+    sources = {cmp.ind: [cmp.reaper.filtered_peaks] for cmp in config.comparisons}
+    if config.peaks.curated_include.exists():
+        sources["Curated"] = [config.peaks.curated_include]
+
+    missing = _missing(universe_pieces(config), sources)
+    if missing is None or "Curated" in missing:
+        build_universe(config)
+    elif missing:
+        extend_universe(config, [cmp for cmp in config.comparisons if cmp.ind in missing])
+    return missing != []
 
-    # Load all peaks
-    _peaks = Parallel(n_jobs=-1)(delayed(load_peaks)(cmp) for cmp in config.comparisons)
+
+def build_universe(config: clustering.Config):
+    # Stream all peaks, each comparison (and curated regions) is a bit in the pieces bitsets
+    labels = [cmp.ind for cmp in config.comparisons]
+    streams = [universe.read(cmp.reaper.filtered_peaks, bit) for bit, cmp in enumerate(config.comparisons)]
 
     # Add curated regions
     if config.peaks.curated_include.exists():
-        curated = defaultdict(list)
-        for p in BedTool(config.peaks.curated_include):
-            curated[p.chrom, Orientation.Forward].append(Interval(p.start, p.end))
-            curated[p.chrom, Orientation.Reverse].append(Interval(p.start, p.end))
-        _peaks.append(('Curated', dict(curated)))
+        streams.append(iter(sorted(
+            (p.chrom, p.start, p.end, strand, 1 << len(labels))
+            for p in BedTool(config.peaks.curated_include) for strand in ("+", "-")
+        )))
+        labels.append("Curated")
     else:
         print(f"WARNING: No curated regions found for the {config.ind} dataset")
 
-    # Resolve into individual "pieces"
-    peaks = dict(_peaks)
-    resolved = []
+    universe.save(universe.pieces(universe.merge(streams)), labels, universe_pieces(config))
+
 
-    def resolution(contig: str, orientation: Orientation, start: int, end: int, comparisons: set[Any]) -> list[Any]:
-        if comparisons:
-            resolved.append({"contig": contig, "orientation": orientation, "start": start, "end": end})
-        return []
+def extend_universe(config: clustering.Config, comparisons: list[clustering.pcalling.Config]):
+    # Add new comparisons to the previously built universe: pieces of (old pieces + new peaks) == pieces of all peaks
+    labels, pieces = universe.load(universe_pieces(config))
+    assert all(cmp.ind not in labels for cmp in comparisons), comparisons
+    streams = [pieces] + [
+        universe.read(cmp.reaper.filtered_peaks, bit) for bit, cmp in enumerate(comparisons, start=len(labels))
+    ]
+    labels += [cmp.ind for cmp in comparisons]
+    universe.save(universe.pieces(universe.merge(streams)), labels, universe_pieces(config))
+
+
+def universe_pieces(config: clustering.Config) -> Path:
+    return config.peaks.universe.with_suffix("").with_suffix(".pieces.bed.gz")
+
+
+def load_universe(config: clustering.Config) -> pd.DataFrame:
+    # Resolved universe "pieces"
+    resolved = defaultdict(list)
+    _, pieces = universe.load(universe_pieces(config))
+    for contig, start, end, strand, _ in pieces:
+        resolved["contig"].append(contig)
+        resolved["orientation"].append(strand)
+        resolved["start"].append(start)
+        resolved["end"].append(end)
+
+    resolved = pd.DataFrame(resolved, columns=["contig", "orientation", "start", "end"])
+    orientations = {x: Orientation(x) for x in resolved["orientation"].unique()}
+    resolved["orientation"] = resolved["orientation"].map(orientations)
+    return resolved
+
+
+def _missing(path: Path, sources: dict[str, list[Path]]) -> list[str] | None:
+    # Labels absent from the saved bitsets. None if everything must be rebuilt: nothing is saved yet, a saved label
+    # is gone or its sources were modified after the save.
+    if not path.exists() or not universe.labels_path(path).exists():
+        return None
+    labels, _ = universe.load(path)
+    mtime = path.stat().st_mtime_ns
+    for label in labels:
+        if label not in sources or any(x.stat().st_mtime_ns > mtime for x in sources[label]):
+            return None
+    return [x for x in sources if x not in labels]
+
+
+def publish_universe(data: pd.DataFrame, plane: utils.shared.Plane) -> utils.shared.Handle:
+    # Columns used by the annotation features, orientations are stored as symbols
+    symbols = {x: Orientation(x).symbol() for x in set(data['orientation'])}
+    return plane.publish(
+        contig=data['contig'].to_numpy(dtype=str), orientation=data['orientation'].map(symbols).to_numpy(dtype=str),
+        start=data['start'].to_numpy(dtype=np.int64), end=data['end'].to_numpy(dtype=np.int64),
+    )
 
-    countit.utils.resolve_annotation(peaks, resolution)
-    return pd.DataFrame(resolved)
+
+def universe_view(handle: utils.shared.Handle, start: int, end: int) -> pd.DataFrame:
+    # Rows [start, end) of the published universe, numeric columns are memory-mapped
+    arrays = handle.load()
+    orientation = arrays['orientation'][start:end]
+    orientations = {x: Orientation(x) for x in np.unique(orientation)}
+    return pd.DataFrame({
+        "contig": arrays['contig'][start:end], "orientation": [orientations[x] for x in orientation],
+        "start": arrays['start'][start:end], "end": arrays['end'][start:end],
+    })
 
 
 def replication(data: pd.DataFrame, config: clustering.Config, which: Literal['raw', 'filtered']):
-    def overlap_with_peaks(cmp: clustering.pcalling.Config) -> dict[str, int]:
-        index = defaultdict(intervaltree.IntervalTree)
+    def load_peaks(cmp: clustering.pcalling.Config) -> dict[tuple[str, Orientation], tuple[np.ndarray, np.ndarray]]:
         path = {'raw': cmp.reaper.raw_peaks, 'filtered': cmp.reaper.filtered_peaks}[which]
         bed = pd.read_csv(path, sep='\t', header=None, dtype=BED_DTYPES)
-        for contig, start, end, _, _, strand in bed.itertuples(index=False, name=None):
-            index[contig, strand].addi(start, end)
-        index = {(contig, Orientation(strand)): itree for (contig, strand), itree in index.items()}
-
-        counts = defaultdict(int)
-        for contig, orientation, start, end in data[
-            ['contig', 'orientation', 'start', 'end']
-        ].itertuples(index=False, name=None):
-            if (contig, orientation) in index and index[contig, orientation].overlaps(start, end):
-                counts[contig, orientation, start, end] += 1
-
-        return counts
-
-    counts = Parallel(n_jobs=-1)(delayed(overlap_with_peaks)(cmp) for cmp in config.comparisons)
-    data['Replication'] = [
-        sum(count.get(key, 0) for count in counts)
-        for key in data[['contig', 'orientation', 'start', 'end']].itertuples(index=False, name=None)
-    ]
+
+        # Peaks sorted by start & running maximum of their ends
+        index = {}
+        for (contig, strand), peaks in bed.groupby([0, 5], sort=False):
+            peaks = peaks.sort_values(1)
+            index[contig, Orientation(strand)] = (
+                peaks[1].to_numpy(dtype=np.int64), np.maximum.accumulate(peaks[2].to_numpy(dtype=np.int64))
+            )
+        return index
+
+    rows = data.groupby(['contig', 'orientation'], sort=False).indices
+    starts, ends = data['start'].to_numpy(dtype=np.int64), data['end'].to_numpy(dtype=np.int64)
+
+    replicated = np.zeros(len(data), dtype=np.int64)
+    for index in Parallel(n_jobs=-1)(delayed(load_peaks)(cmp) for cmp in config.comparisons):
+        for key, inds in rows.items():
+            if key not in index:
+                continue
+            pstart, pmaxend = index[key]
+
+            # A row overlaps a peak if any peak starting before the row end ends after the row start
+            before = np.searchsorted(pstart, ends[inds], side='left')
+            overlaps = before > 0
+            overlaps[overlaps] = pmaxend[before[overlaps] - 1] > starts[inds[overlaps]]
+            replicated[inds] += overlaps
+
+    data['Replication'] = replicated
     return data
 
 
+def update_covered_regions(config: clustering.Config) -> bool:
+    # Derive covered regions or extend them with comparisons missing from the saved bitsets. True if (re)saved.
+    sources = {cmp.ind: [cmp.reaper.control, cmp.reaper.signal] for cmp in config.comparisons}
+    missing = _missing(config.peaks.covered, sources)
+    if missing is None:
+        derive_covered_regions(config)
+    elif missing:
+        extend_covered_regions(config, [cmp for cmp in config.comparisons if cmp.ind in missing])
+    return missing != []
+
+
 def derive_covered_regions(config: clustering.Config):
-    def _derive_covered_regions(path):
-        bed = pd.read_csv(path, sep='\t', header=None, dtype=BED_DTYPES)
-        parsed = defaultdict(list)
-        for contig, start, end, _, _, strand in bed.itertuples(index=False, name=None):
-            parsed[contig, strand].append(Interval(start, end))
-        return dict(parsed)
+    # Stream control/signal segments, each comparison is a bit in the covered regions bitsets
+    labels = [cmp.ind for cmp in config.comparisons]
+    streams = [
+        universe.read(path, bit)
+        for bit, cmp in enumerate(config.comparisons)
+        for path in [cmp.reaper.control, cmp.reaper.signal]
+    ]
+    _save_covered_regions(config, labels, universe.merge(streams))
 
-    # Calculate covered regions
-    _covered = Parallel(n_jobs=-1)(
-        delayed(_derive_covered_regions)(path)
-        for cmp in config.comparisons
+
+def extend_covered_regions(config: clustering.Config, comparisons: list[clustering.pcalling.Config]):
+    # Add new comparisons to the previously derived covered regions: closing gaps is associative w.r.t. the union
+    labels, covered = universe.load(config.peaks.covered)
+    assert all(cmp.ind not in labels for cmp in comparisons), comparisons
+    streams = [covered] + [
+        universe.read(path, bit)
+        for bit, cmp in enumerate(comparisons, start=len(labels))
         for path in [cmp.reaper.control, cmp.reaper.signal]
-    )
-    allkeys = set(k for d in _covered for k in d)
+    ]
+    _save_covered_regions(config, labels + [cmp.ind for cmp in comparisons], universe.merge(streams))
 
-    covered = []
-    covgroups = defaultdict(list)
-    for seqid, strand in allkeys:
-        allsegments = [segment for parsed in _covered for segment in parsed.get((seqid, strand), [])]
-        for segment in Interval.merge_within(allsegments, distance=config.peaks.coverage_gaps_tolerance):
-            covered.append(pybedtools.Interval(seqid, segment.start, segment.end, strand=str(strand)))
-            covgroups[seqid, strand].append(segment)
+
+def _save_covered_regions(config: clustering.Config, labels: list[str], records: Iterator[universe.Record]):
+    # Calculate covered regions
+    covered = universe.covered(records, tolerance=config.peaks.coverage_gaps_tolerance)
+    universe.save(covered, labels, config.peaks.covered)
 
     # Calculate all not covered regions
-    not_covered = []
     seqsizes = utils.assembly.seqsizes(config.organism)
-    for (seqid, strand), cov in covgroups.items():
-        cov = sorted(cov, key=lambda x: x.start)
-        if cov[0].start > 0:
-            not_covered.append(pybedtools.Interval(seqid, 0, cov[0].start, strand=str(strand)))
-        for prv, nxt in zip(cov[:-1], cov[1:]):
-            not_covered.append(pybedtools.Interval(seqid, prv.end, nxt.start, strand=str(strand)))
-        if cov[-1].end < seqsizes[seqid]:
-            not_covered.append(pybedtools.Interval(seqid, cov[-1].end, seqsizes[seqid], strand=str(strand)))
-
-    # Save the results
-    config.peaks.covered.parent.mkdir(parents=True, exist_ok=True)
-    BedTool(covered).sort().saveas(config.peaks.covered)
-
-    config.peaks.not_covered.parent.mkdir(parents=True, exist_ok=True)
-    BedTool(not_covered).sort().saveas(config.peaks.not_covered)
+    _, covered = universe.load(config.peaks.covered)
+    universe.save(universe.complement(covered, seqsizes), None, config.peaks.not_covered)
 
 
 def editing_sites(data: pd.DataFrame, config: clustering.Config):
     host = utils.assembly.get(organism=config.host)
-    allsites = defaultdict(set)
 
-    # Add putative (rediportal) and all detected editing sites
-    paths = [host.rediportal, A2I.tracks.all_passed / f"{host.name}.bed.gz"]
-    for path in paths:
-        assert path.exists(), path
-        sites = pd.read_csv(path, sep='\t', header=None, dtype=BED_DTYPES)
-        for contig, start, end, _, _, strand in sites.itertuples(index=False, name=None):
-            allsites[contig, Orientation(strand)].add((start, end))
+    # Putative (rediportal) and all detected editing sites
+    indices = [
+        utils.sites.SiteIndex(host.rediportal_index),
+        utils.sites.SiteIndex(A2I.tracks.all_passed / f"{host.name}.npz")
+    ]
 
-    # Create an index of editing sites
-    itrees = defaultdict(lambda: intervaltree.IntervalTree())
-    for (contig, orient), sites in allsites.items():
-        for start, end in sites:
-            itrees[contig, orient].addi(start, end)
-
-    # Annotate peaks
-    annotation = []
-    for contig, orientation, start, end in data[
-        ['contig', 'orientation', 'start', 'end']
-    ].itertuples(index=False, name=None):
-        total = 0
-        for _ in itrees[contig, orientation].overlap(start, end):
-            total += 1
-        annotation.append(total)
-    return {"Editing sites": annotation}
+    # Annotate peaks: count distinct sites within each [start, end) range
+    annotation = np.zeros(len(data), dtype=np.int64)
+    starts, ends = data['start'].to_numpy(), data['end'].to_numpy()
+    for (contig, orientation), rows in data.groupby(['contig', 'orientation'], sort=False).indices.items():
+        strand = Orientation(orientation).symbol()
+        positions = np.union1d(*[index.positions(contig, strand) for index in indices])
+        annotation[rows] = np.searchsorted(positions, ends[rows]) - np.searchsorted(positions, starts[rows])
+    return {"Editing sites": annotation.tolist()}
 
 
 def repeats(data: pd.DataFrame, config: clustering.Config):
     host = utils.assembly.get(organism=config.host)
     host_contigs = set(host.seqid.sizes())
+    index = utils.repmasker.RepeatIndex(host.repmasker_index)
 
-    # Construct the Repeat Masker Index
-    itrees = defaultdict(lambda: intervaltree.IntervalTree())
-    repmasker = pd.read_csv(host.repmasker, sep='\t', header=None, dtype=BED_DTYPES)
-    for contig, start, end, name, _, _ in repmasker.itertuples(index=False, name=None):
-        itrees[contig, '.'].addi(start, end, data=name)
-    itrees = dict(itrees)
-
-    # Annotate peaks
-    annotation = []
-    for contig, start, end in data[['contig', 'start', 'end']].itertuples(index=False, name=None):
+    # Annotate peaks with the dominant repeat (by the overlap length)
+    annotation = np.empty(len(data), dtype=object)
+    starts, ends = data['start'].to_numpy(), data['end'].to_numpy()
+    for contig, rows in data.groupby('contig', sort=False).indices.items():
         if contig not in host_contigs:
-            annotation.append("Not host")
-            continue
-
-        weights = defaultdict(int)
-        for it in itrees[contig, '.'].overlap(start, end):  # type: intervaltree.Interval
-            length = min(it.end, end) - max(it.begin, start)
-            assert length > 0
-            weights[it.data] += length
-        weights["Repeat-free"] = (end - start) - sum(weights.values())
-
-        annotation.append(max(weights.items(), key=lambda x: x[1])[0])
-    return {"RepeatMasker": annotation}
+            annotation[rows] = "Not host"
+        else:
+            annotation[rows] = index.dominant(contig, starts[rows], ends[rows])
+    return {"RepeatMasker": annotation.tolist()}
 
 
 def genomic_regions(data: pd.DataFrame, config: clustering.Config):
     seqsizes = utils.assembly.seqsizes([config.host])
+    index = annotation.load.resolved_regions(config.assembly)
 
-    itrees = defaultdict(IntervalTree)
-    for name, locs in annotation.load.resolved_annotation(config.assembly).items():
-        for (seqid, orient), intervals in locs.items():
-            for interval in intervals:
-                itrees[seqid, orient].addi(interval.start, interval.end, data=name)
-    itrees = dict(itrees)
-
-    gregions = []
-    noannotation = set()
-    for contig, orient, start, end in data[
-        ['contig', 'orientation', 'start', 'end']
-    ].itertuples(index=False, name=None):
-        if contig not in seqsizes:
-            gregions.append("Not host")
-            continue
-        elif (key := (contig, orient)) not in itrees:
-            if key not in noannotation:
-                noannotation.add((contig, orient))
-                print(f"WARNING: No annotations for {contig}:{orient}")
-            gregions.append(None)
-            continue
-
-        hits = {it.data for it in itrees[contig, orient].overlap(start, end)}
+    def classify(hits: frozenset[str]) -> str:
         has_intergenic, has_intronic = "intergenic" in hits, "intron" in hits
         hits -= {"intergenic", "intron"}
 
         if "CDS" in hits:
-            gregions.append("cds")
+            return "cds"
         elif hits:
-            gregions.append("exon")
+            return "exon"
         elif has_intronic:
-            gregions.append("intron")
+            return "intron"
         else:
             assert has_intergenic
-            gregions.append("intergenic")
+            return "intergenic"
+
+    # Category sets overlapping each peak, resolved once per distinct set
+    allhits = index.lookup(data['contig'], data['orientation'], data['start'], data['end'])
+    labels = {hits: classify(hits) for hits in set(allhits) if hits}
+    known = {key: key in index for key in set(zip(data['contig'], data['orientation']))}
 
+    gregions = []
+    noannotation = set()
+    for contig, orient, hits in zip(data['contig'], data['orientation'], allhits):
+        if contig not in seqsizes:
+            gregions.append("Not host")
+        elif not known[key := (contig, orient)]:
+            if key not in noannotation:
+                noannotation.add(key)
+                print(f"WARNING: No annotations for {contig}:{orient}")
+            gregions.append(None)
+        else:
+            gregions.append(labels[hits] if hits else classify(hits))
     return {"Region": gregions}
 
 
@@ -296,8 +338,7 @@ def closest_neighbor_and_merged_length(data: pd.DataFrame):
 
 def dsRNA(data: pd.DataFrame, config: clustering.Config):
     # Load filtered dsRNAs
-    with open(config.dsRNA.filtered, 'rb') as stream:
-        dsRNAs = pickle.load(stream)
+    dsRNAs = utils.repeto.InvRepeatStore(config.dsRNA.filtered_store)
 
     def job(contig: str, orientation: Orientation, repeats: list[InvRepeat], peaks: list[Interval]):
         # Index repeats
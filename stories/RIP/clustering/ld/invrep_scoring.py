@@ -1,6 +1,10 @@
-from bisect import bisect_left
-from collections import defaultdict
-from itertools import chain
+import hashlib
+import os
+import tempfile
+from bisect import bisect_right
+from contextlib import ExitStack
+from heapq import heapify, heappop
+from pathlib import Path
 from typing import Optional
 
 import numpy as np
@@ -14,9 +18,13 @@ from intervaltree import IntervalTree
 
 from stories.RIP import pcalling
 
+# Cache of averaged signal/control tracks (one .npy file per comparison/contig/strand)
+TRACKS = Path(__file__).parent / "results" / "tracks"
+TRACKS_CHUNK = 16 * 1024 * 1024
+
 
 class ExperimentTracks:
-    def __init__(self, cmp: pcalling.Config):
+    def __init__(self, cmp: pcalling.Config, cache: Optional[Path] = TRACKS):
         signal, control = {Strand.Forward: [], Strand.Reverse: []}, {Strand.Forward: [], Strand.Reverse: []}
         for exps, saveto in (cmp.signal, signal), (cmp.control, control):
             for exp in exps:
@@ -31,6 +39,7 @@ class ExperimentTracks:
         self._contig: Optional[str] = None
         self._ctglen: Optional[int] = None
         self._strand: Optional[Strand] = None
+        self._regions: Optional[list[Interval]] = None
 
         self._signal_path = signal
         self._signal_values: Optional[npt.NDArray[np.float32]] = None
@@ -38,31 +47,89 @@ class ExperimentTracks:
         self._control_path = control
         self._control_values: Optional[npt.NDArray[np.float32]] = None
 
-    def open(self, contig: str, ctglen: int, strand: Strand) -> 'ExperimentTracks':
+        self._cache = cache / cmp.ind.replace("/", "-").replace(" ", "-") if cache is not None else None
+
+    def open(
+            self, contig: str, ctglen: int, strand: Strand, regions: Optional[list[Interval]] = None
+    ) -> 'ExperimentTracks':
         self._contig = contig
         self._ctglen = ctglen
         self._strand = strand
 
-        # Load the whole contig into memory and calculate the average signal/control across all experiments
-        results = []
-        for paths in self._control_path[strand], self._signal_path[strand]:
-            values = np.zeros(ctglen, dtype=np.float32)
-            for p in paths:
-                with pyBigWig.open(p.as_posix()) as bw:
-                    fetched = bw.values(contig, 0, ctglen, numpy=True)
+        # Windowed mode: only the union of the requested regions is kept in memory
+        self._regions = Interval.merge(list(regions)) if regions is not None else None
+        self._windows = self._regions if self._regions is not None else [Interval(0, ctglen)]
+        self._offsets = [0]
+        for window in self._windows:
+            self._offsets.append(self._offsets[-1] + window.len())
+
+        self._control_values = self._load("control", self._control_path[strand])
+        self._signal_values = self._load("signal", self._signal_path[strand])
+        return self
+
+    def _average(
+            self, paths: list[Path], windows: list[Interval], saveto: npt.NDArray[np.float32]
+    ) -> npt.NDArray[np.float32]:
+        # Calculate the average signal/control across all experiments window by window
+        with ExitStack() as stack:
+            bigwigs = [stack.enter_context(pyBigWig.open(p.as_posix())) for p in paths]
+
+            offset = 0
+            for window in windows:
+                values = saveto[offset: offset + window.len()]
+                values[:] = 0
+                for bw in bigwigs:
+                    fetched = bw.values(self._contig, window.start, window.end, numpy=True)
                     fetched[np.isnan(fetched)] = 0
                     values += fetched
-                del fetched
-            values /= len(paths)
-            results.append(values)
-        self._control_values, self._signal_values = results
-        return self
+                    del fetched
+                values /= len(paths)
+                offset += window.len()
+        return saveto
+
+    def _load(self, tag: str, paths: list[Path]) -> npt.NDArray[np.float32]:
+        if self._cache is None:
+            return self._average(paths, self._windows, np.empty(self._offsets[-1], dtype=np.float32))
+
+        # Cached tracks are invalidated when any of the source bigWigs changes
+        digest = hashlib.md5()
+        for p in paths:
+            stat = p.stat()
+            digest.update(f"{p.resolve()}:{stat.st_size}:{stat.st_mtime_ns}\n".encode())
+        saveto = self._cache / f"{self._contig}_{self._strand}.{tag}.{digest.hexdigest()}.npy"
+
+        # Build once (chunk by chunk to keep the memory bounded), workers share the memory-mapped pages afterward
+        if not saveto.exists():
+            saveto.parent.mkdir(parents=True, exist_ok=True)
+            fd, tmp = tempfile.mkstemp(dir=saveto.parent, suffix=".npy")
+            os.close(fd)
+
+            chunks = [Interval(x, min(x + TRACKS_CHUNK, self._ctglen)) for x in range(0, self._ctglen, TRACKS_CHUNK)]
+            values = np.lib.format.open_memmap(tmp, mode='w+', dtype=np.float32, shape=(self._ctglen,))
+            self._average(paths, chunks, values).flush()
+            del values
+            os.replace(tmp, saveto)
+
+        values = np.load(saveto, mmap_mode='r')
+        assert values.shape == (self._ctglen,) and values.dtype == np.float32, (saveto, values.shape, values.dtype)
+
+        if self._regions is not None:
+            values = np.concatenate([values[window.start: window.end] for window in self._windows])
+        return values
+
+    def _locate(self, start: int, end: int) -> slice:
+        # Translate contig coordinates to the loaded windows
+        ind = bisect_right(self._windows, start, key=lambda x: x.start) - 1
+        assert ind >= 0 and self._windows[ind].start <= start <= end <= self._windows[ind].end, \
+            (self._contig, start, end, self._windows[max(ind, 0)])
+        offset = self._offsets[ind] + start - self._windows[ind].start
+        return slice(offset, offset + end - start)
 
     def signal(self, start: int, end: int):
-        return self._signal_values[start:end]
+        return self._signal_values[self._locate(start, end)]
 
     def control(self, start: int, end: int):
-        return self._control_values[start:end]
+        return self._control_values[self._locate(start, end)]
 
     def score(self, start: int, end: int, insulators: list[tuple[int, int]], peaks: IntervalTree) -> 'ScoreState':
         diff = self.signal(start, end) - self.control(start, end)
@@ -72,12 +139,50 @@ class ExperimentTracks:
         return ScoreState(start, end, diff, insulators, peaks)
 
     def __getstate__(self):
-        return self._contig, self._ctglen, self._strand, self._signal_path, self._control_path
+        return (
+            self._contig, self._ctglen, self._strand, self._regions, self._signal_path, self._control_path, self._cache
+        )
 
     def __setstate__(self, state):
-        self._contig, self._ctglen, self._strand, self._signal_path, self._control_path = state
+        (self._contig, self._ctglen, self._strand, self._regions,
+         self._signal_path, self._control_path, self._cache) = state
         if self._contig and self._strand:
-            self.open(self._contig, self._ctglen, self._strand)
+            self.open(self._contig, self._ctglen, self._strand, self._regions)
+
+
+@dataclass(frozen=True)
+class Arms:
+    # Flat arrays of InvRepeat segments, i-th InvRepeat owns segments offsets[i]:offsets[i + 1]
+    offsets: npt.NDArray[np.int64]
+    lstart: npt.NDArray[np.int64]
+    lend: npt.NDArray[np.int64]
+    rstart: npt.NDArray[np.int64]
+    rend: npt.NDArray[np.int64]
+
+    @staticmethod
+    def from_invrep(irs: list[InvRepeat]) -> 'Arms':
+        offsets, coords = [0], []
+        for ir in irs:
+            for segment in ir.segments:
+                coords.append((segment.left.start, segment.left.end, segment.right.start, segment.right.end))
+            offsets.append(len(coords))
+
+        coords = np.asarray(coords, dtype=np.int64).reshape(-1, 4)
+        return Arms(np.asarray(offsets, dtype=np.int64), *coords.T.copy())
+
+    def select(self, inds: npt.ArrayLike) -> 'Arms':
+        inds = np.asarray(inds, dtype=np.int64)
+        starts, lengths = self.offsets[inds], self.offsets[inds + 1] - self.offsets[inds]
+
+        offsets = np.zeros(len(inds) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        segments = np.repeat(starts - offsets[:-1], lengths) + np.arange(offsets[-1])
+        return Arms(
+            offsets, self.lstart[segments], self.lend[segments], self.rstart[segments], self.rend[segments]
+        )
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
 
 
 @dataclass(frozen=True)
@@ -88,45 +193,72 @@ class ScoreState:
     insulators: list[int]
     peaks: IntervalTree
     max_overlap: int = field(init=False)
+    coverage: npt.NDArray[np.int64] = field(init=False)
 
     def __attrs_post_init__(self):
         total_length = sum(x.length() for x in self.peaks)
         object.__setattr__(self, "max_overlap", total_length)
 
+        # Cumulative peaks coverage, i.e. the overlap with [start, end) is coverage[end] - coverage[start]
+        depth = np.zeros(self.end - self.start + 1, dtype=np.int64)
+        for it in self.peaks:
+            start, end = max(it.begin, self.start), min(it.end, self.end)
+            if start < end:
+                depth[start - self.start] += 1
+                depth[end - self.start] -= 1
+        coverage = np.zeros_like(depth)
+        np.cumsum(np.cumsum(depth)[:-1], out=coverage[1:])
+        object.__setattr__(self, "coverage", coverage)
+
     def _score(self, left: Interval, right: Interval):
         lscore = self.scores[left.start - self.start: left.end - self.start]
         rscore = self.scores[right.start - self.start: right.end - self.start][::-1]
         return np.minimum(lscore, rscore)
 
     def score(self, ir: InvRepeat) -> float:
-        # Raw score is the total signal across dsRNA arms
-        score = sum(self._score(segment.left, segment.right).sum() for segment in ir.segments)
-        score = float(score)
+        return float(self.batch(Arms.from_invrep([ir]))[0])
 
-        weight = 1.0
-        left, right = ir.left_brange(), ir.right_brange()
+    def batch(self, arms: Arms) -> npt.NDArray[np.float64]:
+        if len(arms) == 0:
+            return np.zeros(0, dtype=np.float64)
+
+        # Raw score is the total signal across dsRNA arms
+        # Each left arm position is paired with the mirrored position in the right arm
+        lengths = arms.lend - arms.lstart
+        within = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+        left = np.repeat(arms.lstart - self.start, lengths) + within
+        right = np.repeat(arms.rend - 1 - self.start, lengths) - within
+        explained = np.minimum(self.scores[left], self.scores[right])
+
+        # Accumulate in float32 (segment by segment) like the scalar scoring to keep the greedy ties stable
+        persegment = np.zeros(len(lengths), dtype=np.float32)
+        nonempty = lengths > 0
+        if nonempty.any():
+            persegment[nonempty] = np.add.reduceat(explained, (np.cumsum(lengths) - lengths)[nonempty])
+        score = np.add.reduceat(persegment, arms.offsets[:-1]).astype(np.float64)
+
+        # Bounding ranges of dsRNA arms
+        first, last = arms.offsets[:-1], arms.offsets[1:] - 1
+        lbstart, lbend = arms.lstart[first], arms.lend[last]
+        rbstart, rbend = arms.rstart[last], arms.rend[first]
 
         # Downscale the score based on the overlap between dsRNA arms and sample peaks
-        overlap = 0
-        for segment in left, right:
-            for ov in self.peaks.overlap(segment.start, segment.end):
-                overlap += ov.overlap_size(segment.start, segment.end)
-        weight *= overlap / self.max_overlap
+        overlap = self.coverage[lbend - self.start] - self.coverage[lbstart - self.start] + \
+                  self.coverage[rbend - self.start] - self.coverage[rbstart - self.start]
+        weight = overlap / self.max_overlap
 
         # Downscale the score based on the distance between the two arms
-        distance = right.start - left.end
-        if distance > 1_000:
-            weight /= (distance / 1_000)
+        distance = rbstart - lbend
+        weight = np.where(distance > 1_000, weight / (distance / 1_000), weight)
 
         # Downscale the score if there is an insulator between the two arms
-        lind = bisect_left(self.insulators, left.end)
-        rind = bisect_left(self.insulators, right.start)
-        if lind != rind:
-            weight /= 2 ** min(20, abs(lind - rind))
-
-        score *= weight
+        insulators = np.asarray(self.insulators, dtype=np.int64)
+        crossed = np.abs(
+            np.searchsorted(insulators, lbend, side='left') - np.searchsorted(insulators, rbstart, side='left')
+        )
+        weight /= 2.0 ** np.minimum(20, crossed)
 
-        return score
+        return score * weight
 
     def resolve(self, ir: InvRepeat) -> float:
         score = 0
@@ -143,6 +275,62 @@ class ScoreState:
         return score
 
 
+def solve(scoring: ScoreState, candidates: list[InvRepeat], min_fraction: float = 0.1) -> list[tuple[float, InvRepeat]]:
+    if not candidates:
+        return []
+
+    # We can include in the solution all segments with a score >= 10% of the max observed score
+    # (simple heuristic to speed up the process)
+    arms = Arms.from_invrep(candidates)
+    scores = scoring.batch(arms).tolist()
+    minscore = max(1e-32, min_fraction * max(scores))
+
+    # Index candidate arms to find candidates affected by the consumed signal
+    index = IntervalTree()
+    for ind, ir in enumerate(candidates):
+        for arm in ir.left_brange(), ir.right_brange():
+            index.addi(arm.start, arm.end, ind)
+
+    # Rank is the position of the candidate in the previous round, it's used to break ties between equal scores
+    ranks = {ind: ind for ind, score in enumerate(scores) if score >= minscore}
+
+    # Greedy algorithm based on scoring individual segments
+    solution = []
+    while ranks:
+        queue = [(-scores[ind], -rank, ind) for ind, rank in ranks.items()]
+        heapify(queue)
+
+        # We can include in the solution all top-scored & non-overlapping segments
+        # Overlapping segments must be re-scored in the next iteration
+        resolved, left, taken = [], [], IntervalTree()
+        while queue:
+            _, _, ind = heappop(queue)
+            lbrange, rbrange = candidates[ind].left_brange(), candidates[ind].right_brange()
+            if taken.overlaps(lbrange.start, lbrange.end) or taken.overlaps(rbrange.start, rbrange.end):
+                left.append(ind)
+            else:
+                resolved.append(ind)
+                taken.addi(lbrange.start, lbrange.end)
+                taken.addi(rbrange.start, rbrange.end)
+
+        # Resolve the selected segments and "consume" their signal
+        affected = set()
+        for ind in resolved:
+            ir = candidates[ind]
+            scoring.resolve(ir)
+            solution.append((scores[ind], ir))
+            for segment in ir.seqranges():
+                affected.update(x.data for x in index.overlap(segment.start, segment.end))
+
+        # Only candidates overlapping the consumed signal might change their score
+        rescore = [ind for ind in left if ind in affected]
+        for ind, score in zip(rescore, scoring.batch(arms.select(rescore)).tolist()):
+            scores[ind] = score
+
+        ranks = {ind: rank for rank, ind in enumerate(left) if scores[ind] >= minscore}
+    return solution
+
+
 def from_dsRNA_coordinates_to_global(rna: InvRepeat, intervals: list[Interval]) -> list[InvRepeat]:
     result = []
 
@@ -190,46 +378,67 @@ def from_dsRNA_coordinates_to_global(rna: InvRepeat, intervals: list[Interval])
 
 
 def filter_segments(rna: InvRepeat, solutions: list[InvRepeat], min_samples: int):
-    solutions = sorted(segment.left for solution in solutions for segment in solution.segments)
+    return filter_segments_batch([(rna, solutions)], min_samples)[0]
+
+
+def filter_segments_batch(
+        records: list[tuple[InvRepeat, list[InvRepeat]]], min_samples: int
+) -> list[tuple[list[InvRepeat], list[str]]]:
+    if not records:
+        return []
 
     # Map solutions to dsRNA coordinates
     # Suffice to map only the left arm, the right arm is always the same
-    mapped, pos = [], 0
-    for segment in rna.segments:
-        for solution in solutions:
-            if (ov := segment.left.intersection(solution)) is not None:
-                mapped.append(Interval(ov.start - segment.left.start + pos, ov.end - segment.left.start + pos))
-        pos += segment.left.len()
-    mapped = sorted(mapped)
+    # All dsRNAs are placed one after another (with a gap) to process them in a single sweep
+    mstart, mend, origins = [], [], [0]
+    for rna, solutions in records:
+        segments = np.asarray([(x.left.start, x.left.end) for x in rna.segments], dtype=np.int64)
+        positions = np.zeros(len(segments) + 1, dtype=np.int64)
+        np.cumsum(segments[:, 1] - segments[:, 0], out=positions[1:])
+        positions += origins[-1]
+
+        solutions = np.asarray(
+            [(x.left.start, x.left.end) for solution in solutions for x in solution.segments], dtype=np.int64
+        ).reshape(-1, 2)
+
+        # Each solution overlaps dsRNA segments [first, last)
+        first = np.searchsorted(segments[:, 1], solutions[:, 0], side='right')
+        last = np.searchsorted(segments[:, 0], solutions[:, 1], side='left')
+        counts = np.maximum(last - first, 0)
+
+        solind = np.repeat(np.arange(len(solutions)), counts)
+        segind = np.repeat(first, counts) + np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        start = np.maximum(solutions[solind, 0], segments[segind, 0])
+        end = np.minimum(solutions[solind, 1], segments[segind, 1])
+
+        keep = start < end
+        shift = positions[segind[keep]] - segments[segind[keep], 0]
+        mstart.append(start[keep] + shift)
+        mend.append(end[keep] + shift)
+        origins.append(positions[-1] + 1)
+    mstart, mend = np.concatenate(mstart), np.concatenate(mend)
 
     # Select regions that are support by at least X samples
-    # Very slow algorithm, but it's not a bottleneck
-    replicated = defaultdict(list)
-    boundaries = sorted(set(chain.from_iterable((x.start, x.end) for x in mapped)))
-    for start, end in zip(boundaries[:-1], boundaries[1:]):
-        interval = Interval(start, end)
-        count = sum(x.intersects(interval) for x in mapped)
-        if count >= min_samples:
-            replicated[count].append(interval)
-
-    if not replicated:
-        return [], []
-
-    # # Merge-Map each region back to dsRNA coordinates
-    # backmapped, tags = [], []
-    # for count, intervals in replicated.items():
-    #     bckmp = from_dsRNA_coordinates_to_global(rna, Interval.merge(intervals))
-    #     bckmp = sorted([segment for ir in bckmp for segment in ir.segments], key=lambda x: x.left.start)
-    #
-    #     backmapped.append(InvRepeat(bckmp))
-    #     tags.append(count)
-
-    # Merge the intervals and map back to dsRNA coordinates
-    intervals = [it for intervals in replicated.values() for it in intervals]
-    backmapped = from_dsRNA_coordinates_to_global(rna, Interval.merge(intervals))
-
-    segments = sorted([segment for ir in backmapped for segment in ir.segments], key=lambda x: x.left.start)
-    backmapped = [InvRepeat(segments)]
-    tags = [f"N>={min(replicated.keys())}"]
-
-    return backmapped, tags
+    # Number of mapped solutions covering each elementary interval between consecutive boundaries
+    boundaries = np.unique(np.concatenate([mstart, mend]))
+    support = np.searchsorted(np.sort(mstart), boundaries[:-1], side='right') - \
+              np.searchsorted(np.sort(mend), boundaries[:-1], side='right')
+    replicated = support >= min_samples
+    rstart, rend, support = boundaries[:-1][replicated], boundaries[1:][replicated], support[replicated]
+
+    results = []
+    bounds = np.searchsorted(rstart, origins)
+    for (rna, _), origin, lb, rb in zip(records, origins, bounds[:-1], bounds[1:]):
+        if lb == rb:
+            results.append(([], []))
+            continue
+
+        # Merge the intervals and map back to dsRNA coordinates
+        intervals = [Interval(start, end) for start, end in zip(
+            (rstart[lb:rb] - origin).tolist(), (rend[lb:rb] - origin).tolist()
+        )]
+        backmapped = from_dsRNA_coordinates_to_global(rna, Interval.merge(intervals))
+
+        segments = sorted([segment for ir in backmapped for segment in ir.segments], key=lambda x: x.left.start)
+        results.append(([InvRepeat(segments)], [f"N>={int(support[lb:rb].min())}"]))
+    return results
@@ -0,0 +1,121 @@
+import resource
+import time
+from bisect import bisect_right
+from collections.abc import Callable
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from contextlib import nullcontext
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any
+
+import numpy as np
+
+
+@dataclass(frozen=True, slots=True)
+class Task:
+    tag: str  # Human-readable task description
+    size: int  # Input of the memory model (e.g. sequence length), logged for calibration
+    memory: int  # Estimated peak memory, bytes
+    fn: Callable
+    args: tuple
+
+
+def reset_peak_rss():
+    # Linux-only: reset the VmHWM ("high water mark") of the current process
+    try:
+        with open("/proc/self/clear_refs", 'w') as stream:
+            stream.write("5")
+    except OSError:
+        pass
+
+
+def peak_rss() -> int:
+    try:
+        with open("/proc/self/status") as stream:
+            for line in stream:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    # Fallback: lifetime peak of the worker process
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def fit_memory(log: Path, minpoints: int = 32) -> tuple[float, float] | None:
+    # Fit peak RSS = base + per_cell * size^2 to the logged measurements. Tasks can be cheaper than the model predicts
+    # (e.g. cached results), hence only the upper envelope (max RSS per log2 size bin) is fitted by least squares and
+    # the fit is scaled up until it covers every envelope point. None if there is not enough data.
+    if not log.exists():
+        return None
+    sizes, rss = [], []
+    with open(log) as stream:
+        for line in stream:
+            _, size, _, peak, _ = line.rstrip("\n").split("\t")
+            sizes.append(int(size))
+            rss.append(int(peak))
+    if len(sizes) < minpoints:
+        return None
+
+    cells, rss = np.asarray(sizes, dtype=np.float64) ** 2, np.asarray(rss, dtype=np.float64)
+    bins, inverse = np.unique(np.floor(np.log2(np.maximum(cells, 1))), return_inverse=True)
+    if len(bins) < 3:
+        return None
+    envelope = np.full(len(bins), -np.inf)
+    np.maximum.at(envelope, inverse, rss)
+    xs = np.asarray([cells[(inverse == ind) & (rss == envelope[ind])][0] for ind in range(len(bins))])
+
+    per_cell, base = np.polyfit(xs, envelope, 1)
+    base = max(0.0, float(base))
+    if per_cell <= 0:
+        return None
+    scale = max(1.0, float(np.max(envelope / (base + per_cell * xs))))
+    return base * scale, float(per_cell) * scale
+
+
+def _measured(fn: Callable, args: tuple) -> tuple[Any, int, float]:
+    reset_peak_rss()
+    start = time.monotonic()
+    result = fn(*args)
+    return result, peak_rss(), time.monotonic() - start
+
+
+def run(tasks: list[Task], ram: int, cpus: int, log: Path | None = None) -> list[Any]:
+    # Pack tasks under the RAM/CPU budget, largest first. Each time a slot is free, the largest pending task that fits
+    # into the remaining RAM is launched. Tasks exceeding the whole budget are executed alone.
+    # Results are returned in the order of the input tasks.
+    order = sorted(range(len(tasks)), key=lambda x: tasks[x].memory)
+    memory = [tasks[x].memory for x in order]
+
+    results: list[Any] = [None] * len(tasks)
+    running, used, done = {}, 0, 0
+
+    with open(log, 'a') if log is not None else nullcontext() as stream, ProcessPoolExecutor(cpus) as pool:
+        while order or running:
+            while order and len(running) < cpus:
+                ind = bisect_right(memory, ram - used) - 1
+                if ind < 0:
+                    if running:
+                        break
+                    ind = len(order) - 1
+                taskind = order.pop(ind)
+                used += memory.pop(ind)
+
+                task = tasks[taskind]
+                running[pool.submit(_measured, task.fn, task.args)] = taskind
+
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                taskind = running.pop(future)
+                task = tasks[taskind]
+                used -= task.memory
+
+                results[taskind], rss, elapsed = future.result()
+                done += 1
+                print(
+                    f"[{done}/{len(tasks)}] {task.tag}: estimated {task.memory / 1024 ** 3:.2f}GB, "
+                    f"peak RSS {rss / 1024 ** 3:.2f}GB, {elapsed:.1f}s"
+                )
+                if stream is not None:
+                    stream.write(f"{task.tag}\t{task.size}\t{task.memory}\t{rss}\t{elapsed:.3f}\n")
+                    stream.flush()
+    return results
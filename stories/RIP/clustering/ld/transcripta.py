@@ -1,10 +1,12 @@
 from collections import defaultdict
+from collections.abc import Iterable
 from dataclasses import dataclass, field
 
+import numpy as np
+import numpy.typing as npt
 from biobit.core.loc import Interval, Strand
 from biobit.core.loc.mapping import ChainMap
 from biobit.toolkit.annotome import Annotome
-from intervaltree import IntervalTree
 
 from stories import annotation
 
@@ -32,14 +34,77 @@ class Transcript:
         return hash((self.ind, self.contig, self.strand))
 
 
-def parse(assembly) -> dict[tuple[str, Strand], IntervalTree]:
-    index = defaultdict(IntervalTree)
+@dataclass(frozen=True, slots=True)
+class ExonIndex:
+    # Merged exons of all transcripts on a single contig/strand.
+    # Exons of the i-th transcript are starts/ends[offsets[i]:offsets[i + 1]], ordered by their rank.
+    transcripts: npt.NDArray[np.str_]
+    bbox: npt.NDArray[np.int64]
+    offsets: npt.NDArray[np.int64]
+    starts: npt.NDArray[np.int64]
+    ends: npt.NDArray[np.int64]
+
+    @staticmethod
+    def build(transcripts: Iterable[Transcript]) -> 'ExonIndex':
+        inds, bbox, offsets, starts, ends = [], [], [0], [], []
+        for rna in transcripts:
+            exons = Interval.merge(rna.exons)
+            inds.append(rna.ind)
+            bbox.append((exons[0].start, exons[-1].end))
+            starts.extend(x.start for x in exons)
+            ends.extend(x.end for x in exons)
+            offsets.append(len(starts))
+        return ExonIndex(
+            np.asarray(inds, dtype=str), np.asarray(bbox, dtype=np.int64).reshape(-1, 2),
+            np.asarray(offsets, dtype=np.int64), np.asarray(starts, dtype=np.int64), np.asarray(ends, dtype=np.int64)
+        )
+
+    def __len__(self) -> int:
+        return len(self.transcripts)
+
+    def links(self, elements: list[tuple[int, Interval]]) -> list[npt.NDArray[np.int64]]:
+        # Nodes of elements overlapping exons of each transcript, i.e. elements mappable to transcript coordinates.
+        # Each link is meant to be connected to a single anchor (star) rather than all-pairs.
+        if not elements or len(self) == 0:
+            return []
+
+        nodes = np.asarray([node for node, _ in elements], dtype=np.int64)
+        estart = np.asarray([x.start for _, x in elements], dtype=np.int64)
+        eend = np.asarray([x.end for _, x in elements], dtype=np.int64)
+        order = np.argsort(estart, kind='stable')
+        nodes, estart, eend = nodes[order], estart[order], eend[order]
+
+        # Candidate elements overlapping the bounding box of each transcript
+        maxlen = int((eend - estart).max())
+        lo = np.searchsorted(estart, self.bbox[:, 0] - maxlen, side='right')
+        hi = np.maximum(np.searchsorted(estart, self.bbox[:, 1], side='left'), lo)
+        counts = hi - lo
+
+        total = int(counts.sum())
+        if total == 0:
+            return []
+        tinds = np.repeat(np.arange(len(self)), counts)
+        einds = np.repeat(lo - (np.cumsum(counts) - counts), counts) + np.arange(total)
+
+        # Rank of the first exon ending after the element start, the element is mapped if this exon starts before
+        # the element end. Exons are keyed by (transcript, end) to search all transcripts at once.
+        scale = int(max(self.ends.max(), estart.max())) + 1
+        keys = np.repeat(np.arange(len(self)), np.diff(self.offsets)) * scale + self.ends
+        rank = np.searchsorted(keys, tinds * scale + estart[einds], side='right')
+        mapped = rank < self.offsets[tinds + 1]
+        mapped[mapped] = self.starts[rank[mapped]] < eend[einds[mapped]]
+
+        tinds, einds = tinds[mapped], einds[mapped]
+        splits = np.cumsum(np.bincount(tinds, minlength=len(self)))[:-1]
+        return [x for x in np.split(nodes[einds], splits) if len(x) > 1]
+
+
+def parse(assembly) -> dict[tuple[str, Strand], ExonIndex]:
+    index = defaultdict(list)
 
     gencode: Annotome = assembly.gencode.load()
     for rna in gencode.rnas.values():
         if annotation.filters.is_primary(rna) and rna.attrs.type == "protein_coding":
-            transcript = Transcript(rna.ind, rna.loc.seqid, rna.loc.strand, rna.exons)
-            bbox = transcript.bbox()
-            index[rna.loc.seqid, rna.loc.strand].addi(bbox.start, bbox.end, data=transcript)
+            index[rna.loc.seqid, rna.loc.strand].append(Transcript(rna.ind, rna.loc.seqid, rna.loc.strand, rna.exons))
 
-    return index
+    return {key: ExonIndex.build(transcripts) for key, transcripts in index.items()}
@@ -0,0 +1,155 @@
+import gzip
+import heapq
+from collections.abc import Iterable, Iterator
+from pathlib import Path
+
+import utils
+
+# Streaming k-way merge of peak/coverage BED files. Inputs must be sorted by (contig, start) in byte order, as
+# produced by `LC_ALL=C sort -k1,1 -k2,2n` or pcalling/call-peaks.py (locale-aware `sort` isn't accepted).
+# Only the results for the current contig are kept in memory.
+# Each record carries a bitset of supporting sources (e.g. comparisons), source labels are stored next to the results
+# (<name>.labels.txt) so that new sources can be added incrementally.
+Record = tuple[str, int, int, str, int]  # contig, start, end, strand, bits
+
+
+def read(path: Path, bit: int) -> Iterator[Record]:
+    # BED records tagged with a single source bit
+    opener = gzip.open if path.suffix == ".gz" else open
+    prev = None
+    with opener(path, 'rt') as stream:
+        for line in stream:
+            contig, start, end, _, _, strand = line.rstrip("\n").split("\t")[:6]
+            key = (contig, int(start))
+            if prev is not None and key < prev:
+                raise ValueError(f"{path} isn't sorted by (contig, start): {prev} > {key}")
+            prev = key
+            yield contig, key[1], int(end), strand, 1 << bit
+
+
+def load(path: Path) -> tuple[list[str], Iterator[Record]]:
+    # Previously saved records with their bitsets
+    with open(labels_path(path)) as stream:
+        labels = stream.read().splitlines()
+
+    def records():
+        with gzip.open(path, 'rt') as stream:
+            for line in stream:
+                contig, start, end, bits, _, strand = line.rstrip("\n").split("\t")
+                yield contig, int(start), int(end), strand, int(bits, 16)
+
+    return labels, records()
+
+
+def save(records: Iterable[Record], labels: list[str] | None, saveto: Path):
+    # Indexed BED6 with hex bitsets in the name column, the writer moves the results in place only on success
+    if labels is not None:
+        saveto.parent.mkdir(parents=True, exist_ok=True)
+        with open(labels_path(saveto), 'w') as stream:
+            stream.writelines(f"{x}\n" for x in labels)
+
+    with utils.bed.TabixWriter(saveto) as writer:
+        for contig, start, end, strand, bits in records:
+            writer.write(contig, start, end, f"{contig}\t{start}\t{end}\t{bits:x}\t.\t{strand}")
+
+
+def labels_path(path: Path) -> Path:
+    return path.with_suffix("").with_suffix(".labels.txt")
+
+
+def merge(streams: Iterable[Iterator[Record]]) -> Iterator[Record]:
+    return heapq.merge(*streams, key=lambda x: (x[0], x[1]))
+
+
+def covered(records: Iterator[Record], tolerance: int) -> Iterator[Record]:
+    # Union of all records per (contig, strand), gaps up to the tolerance are closed. Bitsets are OR-ed.
+    state: dict[str, list] = {}
+    emitted: list[Record] = []
+    contig = None
+
+    for ctg, start, end, strand, bits in records:
+        if ctg != contig:
+            emitted.extend((contig, s, e, strand, b) for strand, (s, e, b) in state.items())
+            yield from sorted(emitted)
+            contig, state, emitted = ctg, {}, []
+
+        cur = state.get(strand)
+        if cur is not None and start - cur[1] <= tolerance:
+            cur[1], cur[2] = max(cur[1], end), cur[2] | bits
+        else:
+            if cur is not None:
+                emitted.append((contig, cur[0], cur[1], strand, cur[2]))
+            state[strand] = [start, end, bits]
+
+    emitted.extend((contig, s, e, strand, b) for strand, (s, e, b) in state.items())
+    yield from sorted(emitted)
+
+
+def pieces(records: Iterator[Record]) -> Iterator[Record]:
+    # Elementary pieces between all record boundaries per (contig, strand), labelled by the OR of covering bitsets
+    state: dict[str, tuple[list[int], list[tuple[int, int]]]] = {}
+    emitted: list[Record] = []
+    contig = None
+
+    def advance(strand: str, upto: int | None):
+        # Emit pieces up to the given position (or until no records are active)
+        pos, active = state[strand]
+        while active and (upto is None or active[0][0] <= upto):
+            end = active[0][0]
+            if pos[0] < end:
+                emitted.append((contig, pos[0], end, strand, _union(active)))
+                pos[0] = end
+            while active and active[0][0] == end:
+                heapq.heappop(active)
+        if upto is not None:
+            if active and pos[0] < upto:
+                emitted.append((contig, pos[0], upto, strand, _union(active)))
+            pos[0] = upto
+
+    for ctg, start, end, strand, bits in records:
+        if ctg != contig:
+            for key in state:
+                advance(key, None)
+            yield from sorted(emitted)
+            contig, state, emitted = ctg, {}, []
+
+        if strand not in state:
+            state[strand] = ([start], [])
+        advance(strand, start)
+        heapq.heappush(state[strand][1], (end, bits))
+
+    for key in state:
+        advance(key, None)
+    yield from sorted(emitted)
+
+
+def _union(active: list[tuple[int, int]]) -> int:
+    bits = 0
+    for _, b in active:
+        bits |= b
+    return bits
+
+
+def complement(records: Iterator[Record], seqsizes: dict[str, int]) -> Iterator[Record]:
+    # Gaps between records (and contig ends) for each (contig, strand) with at least one record
+    state: dict[str, int] = {}
+    emitted: list[Record] = []
+    contig = None
+
+    for ctg, start, end, strand, _ in records:
+        if ctg != contig:
+            emitted.extend(_tails(contig, state, seqsizes))
+            yield from sorted(emitted)
+            contig, state, emitted = ctg, {}, []
+
+        last = state.get(strand, 0)
+        if last < start:
+            emitted.append((contig, last, start, strand, 0))
+        state[strand] = max(last, end)
+
+    emitted.extend(_tails(contig, state, seqsizes))
+    yield from sorted(emitted)
+
+
+def _tails(contig: str, state: dict[str, int], seqsizes: dict[str, int]) -> list[Record]:
+    return [(contig, end, seqsizes[contig], strand, 0) for strand, end in state.items() if end < seqsizes[contig]]
@@ -2,6 +2,7 @@ import pandas as pd
 from pybedtools import BedTool, Interval
 
 import ld
+import utils
 
 pd.set_option('display.max_rows', 1000)
 pd.set_option('display.max_columns', 500)
@@ -34,7 +35,7 @@ def job(config: ld.Config):
         for contig, start, end, orientation in
         filtered[['contig', 'start', 'end', 'orientation']].itertuples(index=False, name=None)
     ]
-    BedTool(bed).sort().saveas(config.peaks.filtered)
+    utils.bed.tbindex(BedTool(bed).sort(), config.peaks.filtered)
 
 
 for config in ld.Config.load():
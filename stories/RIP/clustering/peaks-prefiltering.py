@@ -1,39 +1,77 @@
+from collections import defaultdict
 from multiprocessing import Pool, cpu_count
 
+import numpy as np
 import pandas as pd
 from pybedtools import BedTool, Interval
 
 import ld
+import utils
 
 pd.set_option('display.max_rows', 1000)
 pd.set_option('display.max_columns', 500)
 pd.set_option('display.width', 1000)
 
+# Universe annotations computed by the worker pool, each task handles a range of rows
+FEATURES = [
+    ld.features.repeats, ld.features.genomic_regions, ld.features.curated_regions, ld.features.editing_sites
+]
+CHUNK = 250_000
+
+
+def annotate(feature, universe: utils.shared.Handle, start: int, end: int, config: ld.Config):
+    results = feature(ld.features.universe_view(universe, start, end), config)
+
+    # Compact columns: labels are returned as (codes, labels) pairs, the rest as numpy arrays
+    compact = {}
+    for col, values in results.items():
+        values = np.asarray(values)
+        if values.dtype.kind in 'OU':
+            labels = {}
+            codes = [labels.setdefault(x, len(labels)) for x in values.tolist()]
+            codes = np.asarray(codes, dtype=np.int32)
+            values = (codes, np.fromiter(labels, dtype=object, count=len(labels)))
+        compact[col] = values
+    return compact
+
 
 def job(config: ld.Config):
-    cache = config.peaks.universe.with_suffix(".pkl")
-    if not cache.exists():
-        # Derive all covered regions to use as natural insulators for the repeto groups
-        ld.features.derive_covered_regions(config)
+    # Derive all covered regions to use as natural insulators for the repeto groups
+    # Only comparisons missing from the previous run are merged into the saved results
+    ld.features.update_covered_regions(config)
+
+    # Create the peaks universe: all observed peak pieces
+    updated = ld.features.update_universe(config)
 
-        # Create the peaks universe: all observed peak pieces
-        universe = ld.features.build_universe(config)
+    cache = config.peaks.universe.with_suffix(".pkl")
+    if updated or not cache.exists():
+        universe = ld.features.load_universe(config)
 
         # Derive all the relevant annotations
         universe = ld.features.replication(universe, config, which='filtered')
         universe = ld.features.closest_neighbor_and_merged_length(universe)
 
-        pool = Pool(cpu_count())
-        for ind, handle in enumerate([
-            pool.apply_async(ld.features.repeats, args=(universe, config)),
-            pool.apply_async(ld.features.genomic_regions, args=(universe, config)),
-            pool.apply_async(ld.features.curated_regions, args=(universe, config)),
-            pool.apply_async(ld.features.editing_sites, args=(universe, config)),
-        ]):
-            handle.wait()
-            assert handle.successful(), f"Failing on {ind}"
-            for col, values in handle.get().items():
-                universe[col] = values
+        # The universe is published once, tasks receive only the plane handle and a range of rows
+        columns = defaultdict(list)
+        with utils.shared.Plane() as plane, Pool(cpu_count()) as pool:
+            handle = ld.features.publish_universe(universe, plane)
+            ranges = [(start, min(start + CHUNK, len(universe))) for start in range(0, len(universe), CHUNK)]
+            tasks = [
+                (feature, pool.apply_async(annotate, args=(feature, handle, start, end, config)))
+                for feature in FEATURES for start, end in ranges
+            ]
+            for feature, task in tasks:
+                task.wait()
+                assert task.successful(), f"Failing on {feature.__name__}"
+                for col, values in task.get().items():
+                    columns[col].append(values)
+
+        # Labels are decoded back to object columns (incl. None), i.e. the saved frames keep their original dtypes
+        for col, values in columns.items():
+            if isinstance(values[0], tuple):
+                universe[col] = np.concatenate([labels[codes] for codes, labels in values])
+            else:
+                universe[col] = np.concatenate(values)
 
         cache.parent.mkdir(parents=True, exist_ok=True)
         with open(cache, 'wb') as stream:
@@ -81,7 +119,7 @@ def job(config: ld.Config):
             for contig, start, end, orientation, replication in
             peaks[['contig', 'start', 'end', 'orientation', 'Replication']].itertuples(index=False, name=None)
         ]
-        BedTool(bed).sort().saveas(saveto)
+        utils.bed.tbindex(BedTool(bed).sort(), saveto)
 
     # Save prefiltered meta for the later use
     passed.to_pickle(config.peaks.prefiltered.with_suffix(".pkl"))
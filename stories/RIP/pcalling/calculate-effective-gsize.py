@@ -1,48 +1,107 @@
-import gzip
+import hashlib
 import pickle
+from collections import defaultdict
+from pathlib import Path
 
 import khmer
-from Bio import SeqIO
+import numpy as np
 from joblib import Parallel, delayed
 
 import ld
+import utils
 from assemblies import GRCm39, CHM13v2
 
 ERROR_RATE = 0.01
 KSIZE = 150
 
+# Contigs are streamed in fixed windows (+ KSIZE - 1 overlap), per-window HLL sketches are merged per contig
+WINDOW = 8 * 1024 ** 2
+CACHE = ld.RESULTS / "effective-genome-size"
+
+
+def cache_key(fasta: Path) -> str:
+    with open(fasta, 'rb') as stream:
+        checksum = hashlib.file_digest(stream, 'sha256').hexdigest()
+    return hashlib.sha256(repr((checksum, KSIZE, ERROR_RATE)).encode()).hexdigest()[:16]
+
+
+def window(fasta: Path, contig: str, start: int, end: int, length: int):
+    # Unique k-mers starting within [start, end) and non-N bases in the window
+    seq = utils.fasta.sequence(fasta, contig, start, min(end + KSIZE - 1, length))
 
-def job(assembly: str, contig: SeqIO.SeqRecord):
     counter = khmer.HLLCounter(ERROR_RATE, KSIZE)
-    counter.consume_string(str(contig.seq))
+    if len(seq) >= KSIZE:
+        counter.consume_string(seq)
 
-    cardinality = counter.estimate_cardinality()
-    length = len(contig.seq)
-    notn = length - contig.seq.count("N") - contig.seq.count("n")
+    notn = (end - start) - seq[:end - start].count("N")
+    whole = start == 0 and end >= length
+    cardinality = counter.estimate_cardinality() if whole else None
+    return contig, np.asarray(counter.counters, dtype=np.uint8), cardinality, notn
 
-    print(f"{contig.id}")
-    print(f"\tUnique {KSIZE}-mers: {cardinality} ({cardinality / length * 100:.2f}%)")
-    print(f"\tNot-N: {notn} ({notn / length * 100:.2f}%)")
-    es = min(cardinality, notn)
-    assert es <= length
-    print(f"\tFinal effective size = {es} ({es / length * 100:.2f}%)")
-    return assembly, contig.id, es
 
+def estimate_cardinality(registers: np.ndarray) -> float:
+    # Raw HyperLogLog estimate of the merged sketch (khmer applies no bias correction above 5m)
+    m = len(registers)
+    alpha = 0.7213 / (1 + 1.079 / m)
+    return alpha * m * m / np.sum(np.exp2(-registers.astype(np.float64)))
 
-workload = []
-for assembly in GRCm39, CHM13v2:
-    with gzip.open(assembly.fasta, 'rt') as stream:
-        for contig in SeqIO.parse(stream, 'fasta'):
-            workload.append((assembly.fasta, contig))
 
-result = Parallel(n_jobs=-1)(
-    delayed(job)(assembly, contig) for assembly, contig in workload
-)
+def effective_size(fasta: Path) -> dict[str, int]:
+    contigs = utils.fasta.contigs(fasta)
+    windows = Parallel(n_jobs=-1)(
+        delayed(window)(fasta, contig, start, min(start + WINDOW, length), length)
+        for contig, length in contigs.items()
+        for start in range(0, length, WINDOW)
+    )
+
+    registers, cardinality, notn = {}, {}, defaultdict(int)
+    for contig, counters, card, nn in windows:
+        registers[contig] = counters if contig not in registers else np.maximum(registers[contig], counters)
+        notn[contig] += nn
+        if card is not None:
+            cardinality[contig] = card
+
+    # Merged sketches in the bias-corrected range are re-estimated by khmer from a single pass over the contig
+    fallback = []
+    for contig, counters in registers.items():
+        if contig in cardinality:
+            continue
+        estimate = estimate_cardinality(counters)
+        if estimate <= 5 * len(counters):
+            fallback.append(contig)
+        else:
+            cardinality[contig] = int(estimate)
+    for contig, _, card, _ in Parallel(n_jobs=-1)(
+            delayed(window)(fasta, contig, 0, contigs[contig], contigs[contig]) for contig in fallback
+    ):
+        cardinality[contig] = card
+
+    result = {}
+    for contig, length in contigs.items():
+        print(f"{contig}")
+        print(f"\tUnique {KSIZE}-mers: {cardinality[contig]} ({cardinality[contig] / length * 100:.2f}%)")
+        print(f"\tNot-N: {notn[contig]} ({notn[contig] / length * 100:.2f}%)")
+        es = min(cardinality[contig], notn[contig])
+        assert es <= length
+        print(f"\tFinal effective size = {es} ({es / length * 100:.2f}%)")
+        result[contig] = es
+    return result
+
+
+effective_sizes = {}
+for assembly in GRCm39, CHM13v2:
+    # Cached against the FASTA checksum and the estimator parameters
+    cache = CACHE / f"{assembly.name}.{cache_key(assembly.fasta)}.pkl"
+    if cache.exists():
+        with open(cache, 'rb') as stream:
+            effective_sizes[assembly.name] = pickle.load(stream)
+        continue
 
-effective_size = {GRCm39.name: {}, CHM13v2.name: {}}
-for assembly, contig, es in result:
-    effective_size[assembly][contig] = es
+    effective_sizes[assembly.name] = effective_size(assembly.fasta)
+    cache.parent.mkdir(parents=True, exist_ok=True)
+    with open(cache, 'wb') as stream:
+        pickle.dump(effective_sizes[assembly.name], stream)
 
 ld.EFFECTIVE_GENOME_SIZE.parent.mkdir(parents=True, exist_ok=True)
 with open(ld.EFFECTIVE_GENOME_SIZE, 'wb') as stream:
-    pickle.dump(effective_size, stream)
+    pickle.dump(effective_sizes, stream)
@@ -1,8 +1,5 @@
 import copy
 import pickle
-from multiprocessing import Pool
-from multiprocessing import cpu_count
-from typing import Any
 
 from biobit import io
 from biobit.core.loc import Strand
@@ -13,7 +10,9 @@ import ld
 import utils
 from stories import normalization
 
-SAVERS = Pool(cpu_count())
+# Single pass: all comparisons share one engine run, every unique set of signal/control BAMs is decoded once
+# and its pileups are reused by all comparisons referencing it. Set to False to run comparisons one by one.
+SINGLE_PASS = True
 
 
 def reader(path: str, layout: Layout) -> io.bam.Reader:
@@ -21,60 +20,49 @@ def reader(path: str, layout: Layout) -> io.bam.Reader:
     return io.bam.Reader(path, inflags=3, exflags=2572, minmapq=0)
 
 
-def save_results(cmp: ld.Config, harvest: list[rp.HarvestRegion]) -> list[tuple[str, Any]]:
+def save_results(cmp: ld.Config, harvest: list[rp.HarvestRegion]):
     total_peaks = sum(len(x.filtered_peaks) for x in harvest)
     print(f"[{cmp.ind}] Finished {cmp.ind} -> {total_peaks:,} peaks")
 
     # Construct & save the BED files
     paths = cmp.reaper
-    for p in paths:
-        p.parent.mkdir(parents=True, exist_ok=True)
-
-    handles = []
 
     # Save segments
     for get_segments, saveto in [
         (lambda x: x.control, paths.control), (lambda x: x.signal, paths.signal), (lambda x: x.modeled, paths.modeled)
     ]:
-        lines = []
+        records = []
         for region in harvest:
             contig = region.contig
             strand = str(region.orientation)
             for segment in get_segments(region):
-                lines.append(f"{contig}\t{segment.start}\t{segment.end}\t.\t.\t{strand}\n")
-        handles.append((saveto, SAVERS.apply_async(ld.write_gz, (saveto, lines))))
+                records.append((contig, segment.start, segment.end, strand))
+        records.sort()
+        with utils.bed.TabixWriter(saveto) as writer:
+            for contig, start, end, strand in records:
+                writer.write(contig, start, end, f"{contig}\t{start}\t{end}\t.\t.\t{strand}")
 
     # Save peaks
     for get_peaks, saveto in [
         (lambda x: x.raw_peaks, paths.raw_peaks), (lambda x: x.filtered_peaks, paths.filtered_peaks)
     ]:
-        lines = []
+        records = []
         for region in harvest:
             contig = region.contig
             strand = str(region.orientation)
             for peak in get_peaks(region):
-                lines.append(f"{contig}\t{peak.interval.start}\t{peak.interval.end}\t.\t{peak.value}\t{strand}\n")
-        handles.append((saveto, SAVERS.apply_async(ld.write_gz, (saveto, lines))))
-    return handles
+                records.append((contig, peak.interval.start, peak.interval.end, peak.value, strand))
+        records.sort()
+        with utils.bed.TabixWriter(saveto) as writer:
+            for contig, start, end, value, strand in records:
+                writer.write(contig, start, end, f"{contig}\t{start}\t{end}\t.\t{value}\t{strand}")
 
 
-scaling = normalization.median_of_ratios()
+def sources_tag(cmp: ld.Config, experiments) -> str:
+    return "|".join(sorted(f"{cmp.project}/{exp.ind}" for exp in experiments))
 
-# Load effective genome size
-with open(ld.EFFECTIVE_GENOME_SIZE, 'rb') as stream:
-    effgsize = pickle.load(stream)
-effgsize = {k: sum(v.values()) for k, v in effgsize.items()}
 
-# Load all RNA models
-with open(ld.RNA_MODELS, 'rb') as stream:
-    rna_models = pickle.load(stream)
-
-# Load all comparisons presets
-presets = ld.Config.load()
-
-handles = []
-engine = rp.Reaper(threads=-1)
-for cmp in presets:
+def workload(cmp: ld.Config) -> rp.Workload:
     # Calculate scaling factors
     assembly = utils.assembly.get(organism=cmp.host)
     reads, _, scfactors = cmp.scaling(scaling[assembly.name])
@@ -93,7 +81,7 @@ for cmp in presets:
     nms = cmp.nms
 
     # Construct the workload
-    workload = rp.Workload()
+    result = rp.Workload()
     for seq, length in seqlens.items():
         seqmodel, seqnms = copy.deepcopy(model), copy.deepcopy(nms)
         for strand in Strand.Forward, Strand.Reverse:
@@ -106,22 +94,50 @@ for cmp in presets:
                 print(f"[{cmp.ind}] No RNA models for {seq} {strand}")
 
         config = rp.Config(seqmodel, enrichment, pcalling, seqnms)
-        workload.add_region(seq, 0, length, config)
+        result.add_region(seq, 0, length, config)
+    return result
+
+
+def run(comparisons: list[ld.Config]) -> dict[str, list[rp.HarvestRegion]]:
+    engine = rp.Reaper(threads=-1)
 
-    # Add the comparison to the engine
-    for tag, exps in (("Signal", cmp.signal), ("Control", cmp.control)):
-        for exp in exps:
-            source, layout = nfcore.rnaseq.extract.bam(exp, factory=reader)
-            engine.add_source(tag, source, layout)
+    # Add each unique set of sources once
+    registered = set()
+    for cmp in comparisons:
+        for exps in cmp.signal, cmp.control:
+            tag = sources_tag(cmp, exps)
+            if tag in registered:
+                continue
+            registered.add(tag)
+            for exp in exps:
+                source, layout = nfcore.rnaseq.extract.bam(exp, factory=reader)
+                engine.add_source(tag, source, layout)
 
-    engine.add_comparison(cmp.ind, "Signal", "Control", workload)
-    harvest = engine.run()
-    assert len(harvest) == 1, (cmp.ind, harvest)
-    harvest = harvest.pop()
+    # Add the comparisons to the engine
+    for cmp in comparisons:
+        engine.add_comparison(cmp.ind, sources_tag(cmp, cmp.signal), sources_tag(cmp, cmp.control), workload(cmp))
+    print(f"Running {len(comparisons)} comparison(s) over {len(registered)} unique source set(s)")
 
-    handles.extend(save_results(cmp, harvest.regions))
+    harvest = {h.comparison: h.regions for h in engine.run()}
+    assert harvest.keys() == {cmp.ind for cmp in comparisons}, (harvest.keys(), [cmp.ind for cmp in comparisons])
+    return harvest
+
+
+scaling = normalization.median_of_ratios()
+
+# Load effective genome size
+with open(ld.EFFECTIVE_GENOME_SIZE, 'rb') as stream:
+    effgsize = pickle.load(stream)
+effgsize = {k: sum(v.values()) for k, v in effgsize.items()}
+
+# Load all RNA models
+with open(ld.RNA_MODELS, 'rb') as stream:
+    rna_models = pickle.load(stream)
+
+# Load all comparisons presets
+presets = ld.Config.load()
 
-for ind, h in handles:
-    h.get()
-    assert h.successful(), f"Failed to save results for {ind} {h.get()}"
-SAVERS.close()
+for batch in [presets] if SINGLE_PASS else [[cmp] for cmp in presets]:
+    harvest = run(batch)
+    for cmp in batch:
+        save_results(cmp, harvest[cmp.ind])
@@ -1,3 +1,4 @@
-from . import filters, paths, load
+from . import filters, paths, load, regions
 from .boundaries import TranscriptionBoundaries
+from .regions import RegionIndex
 from .rna_core import RNACore, IntronCore
@@ -6,6 +6,7 @@ from biobit.toolkit.annotome import Annotome
 
 from . import paths
 from .boundaries import TranscriptionBoundaries
+from .regions import RegionIndex
 from .rna_core import RNACore
 
 
@@ -31,3 +32,8 @@ def transcription_boundaries(assembly: str) -> dict[tuple[str, Strand], Transcri
 def resolved_annotation(assembly: str) -> dict[str, dict[tuple[str, Orientation], list[Interval]]]:
     with open(paths.resolved_annotation.pkl[assembly], 'rb') as stream:
         return pickle.load(stream)
+
+
+@lru_cache(maxsize=None)
+def resolved_regions(assembly: str) -> RegionIndex:
+    return RegionIndex(paths.resolved_annotation.npz[assembly])
@@ -34,3 +34,7 @@ class resolved_annotation:
         "GRCm39": root / "GRCm39.pkl",
         "CHM13v2": root / "CHM13v2.pkl",
     }
+    npz = {
+        "GRCm39": root / "GRCm39.npz",
+        "CHM13v2": root / "CHM13v2.npz",
+    }
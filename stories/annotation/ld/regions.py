@@ -0,0 +1,138 @@
+from collections.abc import Iterable, Mapping
+from pathlib import Path
+
+import numpy as np
+import numpy.typing as npt
+from biobit.core.loc import Interval, Orientation, IntoOrientation
+
+import utils
+
+
+# Resolved annotation as a categorical step function: for each (contig, strand) the genome is split into sorted
+# non-overlapping steps, each step has a code of the category set (e.g. {"CDS"} or {"lncRNA", "pseudogene"}) covering
+# it. Steps of all (contig, strand) pairs are concatenated, the pair k spans offsets[k]:offsets[k + 1].
+# Category sets are stored in the CSR format: set s = labels[members[setoffsets[s]:setoffsets[s + 1]]].
+class RegionIndex:
+    def __init__(self, path: Path):
+        self.path = path
+        arrays = utils.shared.npz_memmap(path)
+        self.starts, self.ends, self.codes = arrays['starts'], arrays['ends'], arrays['codes']
+
+        offsets = np.asarray(arrays['offsets'])
+        self.keys = {str(key): (int(offsets[ind]), int(offsets[ind + 1])) for ind, key in enumerate(arrays['keys'])}
+
+        labels, members, setoffsets = np.asarray(arrays['labels']), arrays['members'], arrays['setoffsets']
+        self.sets = np.empty(len(setoffsets) - 1, dtype=object)
+        self.sets[:] = [
+            frozenset(str(x) for x in labels[members[start:end]]) for start, end in zip(setoffsets[:-1], setoffsets[1:])
+        ]
+
+    @staticmethod
+    def build(
+            annotation: Mapping[str, Mapping[tuple[str, IntoOrientation], Iterable[Interval]]], saveto: Path
+    ) -> 'RegionIndex':
+        labels = sorted(annotation)
+        groups = {}
+        for label, items in annotation.items():
+            for (contig, orient), segments in items.items():
+                groups.setdefault(_key(contig, orient), []).append((labels.index(label), segments))
+
+        keys, offsets, starts, ends, codes, sets = [], [0], [], [], [], {}
+        for key, items in sorted(groups.items()):
+            # Elementary steps between all segment boundaries
+            bounds = set()
+            for _, segments in items:
+                for s in segments:
+                    bounds.update((s.start, s.end))
+            points = np.asarray(sorted(bounds), dtype=np.int64)
+
+            # Labels covering each step (difference arrays)
+            covered = np.zeros((len(labels), len(points) - 1), dtype=np.int32)
+            for label, segments in items:
+                segments = [(s.start, s.end) for s in segments]
+                if not segments:
+                    continue
+                lo, hi = np.searchsorted(points, np.asarray(segments, dtype=np.int64).T)
+                np.add.at(covered[label], lo, 1)
+                np.add.at(covered[label], hi[hi < len(points) - 1], -1)
+            covered = np.cumsum(covered, axis=1) > 0
+
+            # Categorical codes of label sets, steps without labels are dropped
+            rows, inverse = np.unique(covered.T, axis=0, return_inverse=True)
+            rcodes = np.asarray([
+                sets.setdefault(tuple(np.flatnonzero(row)), len(sets)) if row.any() else -1 for row in rows
+            ], dtype=np.int32)[inverse.ravel()]
+
+            # Merge adjacent steps with the same code
+            keep = rcodes >= 0
+            merge = np.zeros(len(rcodes), dtype=bool)
+            merge[1:] = keep[1:] & keep[:-1] & (rcodes[1:] == rcodes[:-1])
+            first = keep & ~merge
+            last = keep & np.append(~merge[1:], True)
+
+            keys.append(key)
+            starts.append(points[:-1][first])
+            ends.append(points[1:][last])
+            codes.append(rcodes[first])
+            offsets.append(offsets[-1] + int(first.sum()))
+
+        members = [list(x) for x in sets]
+        saveto.parent.mkdir(parents=True, exist_ok=True)
+        np.savez(
+            saveto, keys=np.asarray(keys, dtype=str), offsets=np.asarray(offsets, dtype=np.int64),
+            starts=np.concatenate(starts).astype(np.uint32), ends=np.concatenate(ends).astype(np.uint32),
+            codes=np.concatenate(codes), labels=np.asarray(labels, dtype=str),
+            members=np.asarray([x for m in members for x in m], dtype=np.int32),
+            setoffsets=np.cumsum([0] + [len(m) for m in members], dtype=np.int64),
+        )
+        return RegionIndex(saveto)
+
+    def __contains__(self, item: tuple[str, IntoOrientation]) -> bool:
+        return _key(*item) in self.keys
+
+    def lookup(
+            self, contigs: Iterable[str], orientations: Iterable[IntoOrientation],
+            starts: npt.ArrayLike, ends: npt.ArrayLike
+    ) -> list[frozenset[str]]:
+        # Union of category sets overlapping each [start, end) range, empty for unknown (contig, orientation)
+        starts, ends = np.asarray(starts, dtype=np.int64), np.asarray(ends, dtype=np.int64)
+        orientations = list(orientations)
+        symbols = {x: Orientation(x).symbol() for x in set(orientations)}
+        keys = np.asarray([f"{contig}|{symbols[orient]}" for contig, orient in zip(contigs, orientations)], dtype=str)
+
+        queries, steps = [], []
+        unique, inverse = np.unique(keys, return_inverse=True)
+        order = np.argsort(inverse, kind='stable')
+        for key, rows in zip(unique, np.split(order, np.cumsum(np.bincount(inverse, minlength=len(unique)))[:-1])):
+            if key not in self.keys:
+                continue
+            first, last = self.keys[key]
+            lo = first + np.searchsorted(self.ends[first:last], starts[rows], side='right')
+            hi = first + np.searchsorted(self.starts[first:last], ends[rows], side='left')
+            counts = np.maximum(hi - lo, 0)
+
+            queries.append(np.repeat(rows, counts))
+            steps.append(np.repeat(lo - np.cumsum(counts) + counts, counts) + np.arange(counts.sum()))
+
+        result = np.full(len(keys), frozenset(), dtype=object)
+        if not queries:
+            return result.tolist()
+
+        # Unique (query, code) pairs: most ranges hit a single category set
+        pairs = np.unique(np.stack([
+            np.concatenate(queries), self.codes[np.concatenate(steps)].astype(np.int64)
+        ]), axis=1)
+        queries, codes = pairs
+        single = np.bincount(queries, minlength=len(keys)) == 1
+        mask = single[queries]
+        result[queries[mask]] = self.sets[codes[mask]]
+
+        bounds = np.flatnonzero(np.diff(queries[~mask])) + 1
+        for query, qcodes in zip(np.split(queries[~mask], bounds), np.split(codes[~mask], bounds)):
+            if len(query) > 0:
+                result[query[0]] = frozenset().union(*self.sets[qcodes])
+        return result.tolist()
+
+
+def _key(contig: str, orientation: IntoOrientation) -> str:
+    return f"{contig}|{Orientation(orientation).symbol()}"
@@ -190,6 +190,9 @@ def job(assembly: str):
     with open(saveto, "wb") as stream:
         pickle.dump(annotation, stream, protocol=pickle.HIGHEST_PROTOCOL)
 
+    # Save as a categorical step function for batched lookups
+    ld.regions.RegionIndex.build(annotation, ld.paths.resolved_annotation.npz[assembly.name])
+
     # Save as a bed file
     bed = pybedtools.BedTool([
         pybedtools.Interval(contig, s.start, s.end, strand=str(orient), name=name)
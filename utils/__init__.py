@@ -1,3 +1,3 @@
-from . import seqproj, bed, assembly, repeto, fasta, plot
+from . import seqproj, bed, assembly, repeto, fasta, plot, shared, sites, repmasker
 
-__all__ = ["seqproj", "bed", "assembly", "repeto", "fasta", "plot"]
+__all__ = ["seqproj", "bed", "assembly", "repeto", "fasta", "plot", "shared", "sites", "repmasker"]
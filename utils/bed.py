@@ -1,3 +1,10 @@
+import os
+import queue
+import struct
+import tempfile
+import threading
+import zlib
+from bisect import bisect_right
 from collections import defaultdict
 from pathlib import Path
 from typing import Iterable, Callable, Any, Optional
@@ -7,11 +14,183 @@ from biobit.core.loc import Interval, Orientation, IntoOrientation
 
 
 def tbindex(bed: pybedtools.BedTool, saveto: Path):
-    assert saveto.suffixes[-2:] == [".bed", ".gz"]
+    # Save a sorted BED as BGZF + tabix index in a single pass
+    with TabixWriter(saveto) as writer:
+        for it in bed:
+            writer.write(it.chrom, it.start, it.end, str(it))
 
-    saveto = saveto.with_suffix("")
-    bed.saveas(saveto).tabix(in_place=True, force=True, is_sorted=True)
-    saveto.unlink()
+
+# BGZF blocks hold at most 64KB of (compressed) data, htslib caps the uncompressed payload at 0xff00 bytes
+BGZF_BLOCK = 0xff00
+BGZF_EOF = bytes.fromhex("1f8b08040000000000ff0600424302001b0003000000000000000000")
+
+
+def _bgzf_block(data: bytes, level: int) -> bytes:
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    cdata = compressor.compress(data) + compressor.flush()
+    if len(cdata) > BGZF_BLOCK:
+        # Incompressible data: store it
+        compressor = zlib.compressobj(0, zlib.DEFLATED, -15)
+        cdata = compressor.compress(data) + compressor.flush()
+    header = struct.pack("<4BI2BH2BHH", 0x1f, 0x8b, 8, 4, 0, 0, 0xff, 6, ord("B"), ord("C"), 2, len(cdata) + 25)
+    return header + cdata + struct.pack("<2I", zlib.crc32(data), len(data))
+
+
+def _reg2bin(start: int, end: int) -> int:
+    end -= 1
+    for shift, offset in (14, 4681), (17, 585), (20, 73), (23, 9), (26, 1):
+        if start >> shift == end >> shift:
+            return offset + (start >> shift)
+    return 0
+
+
+# Streaming writer of sorted BED records into a BGZF file with a tabix (.tbi) index.
+# Blocks are compressed and written by a background thread, record offsets are collected on the fly and converted
+# into the tabix binning/linear index on close. Both files are written to temporary paths and moved in place on a
+# successful close, i.e. failed or interrupted writes never leave a complete-looking track behind.
+class TabixWriter:
+    def __init__(self, saveto: Path, level: int = 6, backlog: int = 64):
+        assert saveto.suffixes[-2:] == [".bed", ".gz"], saveto
+        saveto.parent.mkdir(parents=True, exist_ok=True)
+        self.saveto, self.level = saveto, level
+
+        self._buffer, self._blocks = bytearray(), 0
+        self._offsets = [0]  # Compressed offsets of written blocks, filled by the background thread
+        fd, self._tmp = tempfile.mkstemp(dir=saveto.parent, prefix=f".{saveto.name}.", suffix=".tmp")
+        self._tmpindex: str | None = None
+        self._stream = os.fdopen(fd, 'wb')
+        self._error: BaseException | None = None
+        self._queue = queue.Queue(maxsize=backlog)
+        self._thread = threading.Thread(target=self._compress, daemon=True)
+        self._thread.start()
+
+        # Index: contig -> bins {bin: [[start voff, end voff], ...]} and linear index {16kb window: voff}
+        # Virtual offsets are kept as (block, offset in block) until the compressed offsets are known
+        self._contigs: dict[str, tuple[dict[int, list[list]], dict[int, tuple[int, int]]]] = {}
+        self._last: tuple[str, int] | None = None
+
+    def _compress(self):
+        # After a failure the queue is still drained, the error is re-raised by the writing thread
+        while (block := self._queue.get()) is not None:
+            if self._error is not None:
+                continue
+            try:
+                data = _bgzf_block(block, self.level)
+                self._stream.write(data)
+                self._offsets.append(self._offsets[-1] + len(data))
+            except BaseException as e:
+                self._error = e
+
+    def _check(self):
+        if self._error is not None:
+            raise RuntimeError(f"Failed to write {self.saveto}") from self._error
+
+    def _flush(self):
+        self._check()
+        if self._buffer:
+            self._queue.put(bytes(self._buffer))
+            self._buffer.clear()
+            self._blocks += 1
+
+    def write(self, contig: str, start: int, end: int, line: str):
+        self._check()
+        if self._last is None or self._last[0] != contig:
+            assert contig not in self._contigs, f"Records must be grouped by contig: {contig} reappeared"
+            self._contigs[contig] = ({}, {})
+        else:
+            assert self._last[1] <= start, f"Records must be sorted by start: {self._last} > {(contig, start)}"
+        self._last = (contig, start)
+
+        data = line.rstrip("\n").encode() + b"\n"
+        if len(self._buffer) + len(data) > BGZF_BLOCK:
+            self._flush()
+        begin = (self._blocks, len(self._buffer))
+
+        # Lines longer than a block are split across blocks
+        while len(data) > BGZF_BLOCK:
+            self._buffer += data[:BGZF_BLOCK]
+            data = data[BGZF_BLOCK:]
+            self._flush()
+        self._buffer += data
+        finish = (self._blocks, len(self._buffer))
+
+        bins, linear = self._contigs[contig]
+        chunks = bins.setdefault(_reg2bin(start, max(end, start + 1)), [])
+        if chunks and chunks[-1][1] == begin:
+            chunks[-1][1] = finish
+        else:
+            chunks.append([begin, finish])
+        for window in range(start >> 14, (max(end, start + 1) - 1 >> 14) + 1):
+            linear.setdefault(window, begin)
+
+    def close(self):
+        try:
+            self._flush()
+            self._stop()
+            self._check()
+            self._stream.write(BGZF_EOF)
+            self._stream.close()
+
+            fd, self._tmpindex = tempfile.mkstemp(
+                dir=self.saveto.parent, prefix=f".{self.saveto.name}.", suffix=".tbi"
+            )
+            with os.fdopen(fd, 'wb') as stream:
+                index = self._index()
+                for start in range(0, len(index), BGZF_BLOCK):
+                    stream.write(_bgzf_block(index[start:start + BGZF_BLOCK], self.level))
+                stream.write(BGZF_EOF)
+        except BaseException:
+            self.abort()
+            raise
+
+        # The index is moved last: it must not be older than the data
+        index = self.saveto.with_name(self.saveto.name + ".tbi")
+        for tmp, path in (self._tmp, self.saveto), (self._tmpindex, index):
+            os.chmod(tmp, 0o644)
+            os.replace(tmp, path)
+
+    def abort(self):
+        # Stop the background thread and drop everything written so far
+        self._stop()
+        self._stream.close()
+        for tmp in self._tmp, self._tmpindex:
+            if tmp is not None:
+                Path(tmp).unlink(missing_ok=True)
+
+    def _stop(self):
+        if self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join()
+
+    def _index(self) -> bytes:
+        def voff(x: tuple[int, int]) -> int:
+            return self._offsets[x[0]] << 16 | x[1]
+
+        names = b"".join(contig.encode() + b"\0" for contig in self._contigs)
+        # Magic, number of contigs, BED preset (0-based, seq/start/end columns, '#' comments, no skipped lines)
+        index = [b"TBI\1", struct.pack("<8i", len(self._contigs), 0x10000, 1, 2, 3, ord("#"), 0, len(names)), names]
+        for bins, linear in self._contigs.values():
+            index.append(struct.pack("<i", len(bins)))
+            for bin, chunks in bins.items():
+                index.append(struct.pack("<Ii", bin, len(chunks)))
+                index.extend(struct.pack("<2Q", voff(b), voff(e)) for b, e in chunks)
+
+            # Windows without records point to the closest preceding record
+            offsets, last = [], voff(min(linear.values()))
+            for window in range(max(linear) + 1):
+                last = voff(linear[window]) if window in linear else last
+                offsets.append(last)
+            index.append(struct.pack(f"<i{len(offsets)}Q", len(offsets), *offsets))
+        return b"".join(index)
+
+    def __enter__(self) -> 'TabixWriter':
+        return self
+
+    def __exit__(self, exc_type, *_):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
 
 
 def group(
@@ -25,6 +204,25 @@ def group(
     return dict(group)
 
 
+def subtract(intervals: Iterable[Interval], remove: Iterable[Interval]) -> list[Interval]:
+    # In-memory equivalent of bedtools subtract for intervals on the same contig/strand
+    remove = Interval.merge(list(remove))
+    ends = [x.end for x in remove]
+
+    result = []
+    for it in intervals:
+        start = it.start
+        ind = bisect_right(ends, start)
+        while ind < len(remove) and remove[ind].start < it.end:
+            if remove[ind].start > start:
+                result.append(Interval(start, remove[ind].start))
+            start = max(start, remove[ind].end)
+            ind += 1
+        if start < it.end:
+            result.append(Interval(start, it.end))
+    return result
+
+
 class blocks:
     @staticmethod
     def make(
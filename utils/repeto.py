@@ -1,9 +1,21 @@
+import hashlib
+import os
+import pickle
+import shutil
+import tempfile
+from bisect import bisect_left
 from collections import defaultdict
+from collections.abc import Hashable, Mapping, Sequence
 from dataclasses import dataclass
-from typing import Iterator
+from functools import lru_cache
+from heapq import heappop, heappush
+from pathlib import Path
+from typing import Iterator, Iterable
 
+import numpy as np
+import numpy.typing as npt
 from biobit.core.loc import IntoLocus, Orientation, Interval, Locus
-from biobit.toolkit.repeto.repeats import InvRepeat
+from biobit.toolkit.repeto.repeats import InvRepeat, InvSegment
 
 
 @dataclass(frozen=True, slots=True)
@@ -52,19 +64,20 @@ def group(
         assert all(nxt.start > prv.end for nxt, prv in zip(rois[1:], rois[:-1]))
         assert all(nxt.start > prv.end for nxt, prv in zip(insulators[1:], insulators[:-1]))
 
+        groups = []
         cache = [rois[0]]
         start, end = rois[0].start, rois[0].end
 
         total_insulators += len(insulators)
+        insind = 0
         insulate = insulators[0] if insulators else None
-        insulators = insulators[1:]
 
         for roi in rois[1:]:
             distance = roi.start - end
 
             if distance > maxdist:
                 # ROIs are far away - no grouping needed
-                result.append(RepetoGroup(seqid, orientation, Interval(start, end), cache))
+                groups.append(RepetoGroup(seqid, orientation, Interval(start, end), cache))
                 cache = [roi]
                 start, end = roi.start, roi.end
             else:
@@ -76,7 +89,7 @@ def group(
                         cache.append(roi)
                     if end <= insulate.start and roi.start >= insulate.end:
                         # Insulator in between - reset the cache
-                        result.append(RepetoGroup(seqid, orientation, Interval(start, end), cache))
+                        groups.append(RepetoGroup(seqid, orientation, Interval(start, end), cache))
                         cache = [roi]
                         start, end = roi.start, roi.end
                     else:
@@ -89,33 +102,42 @@ def group(
                     cache.append(roi)
 
             # Fast-forward insulators if needed
-            while insulators and insulate and roi.start >= insulate.end:
-                insulate = insulators[0]
-                insulators = insulators[1:]
-
-        result.append(RepetoGroup(seqid, orientation, Interval(start, end), cache))
-
-    # Drop connectors from the result
-    excluding_connectors = []
-    for group in result:
-        # Any overlap with connectors?
-        if (group.contig, group.orientation) not in _connectors:
-            excluding_connectors.append(group)
-            continue
+            while insind + 1 < len(insulators) and insulate and roi.start >= insulate.end:
+                insind += 1
+                insulate = insulators[insind]
+
+        groups.append(RepetoGroup(seqid, orientation, Interval(start, end), cache))
 
-        connectors = Interval.overlap([group.bsegment], _connectors[group.contig, group.orientation])
         if not connectors:
-            excluding_connectors.append(group)
+            result.extend(groups)
             continue
 
-        # Brute force recalculate the ROIs
-        rois = Interval.overlap(_rois[group.contig, group.orientation], [group.bsegment])
-        rois = Interval.merge(rois)
-        if rois:
-            object.__setattr__(group, 'rois', rois)
-            excluding_connectors.append(group)
+        # Drop connectors from the result: groups are sorted and disjoint, and each original ROI lies within
+        # a single group. Hence, a single walk over groups, original ROIs and connectors is enough.
+        original = sorted(_rois[seqid, orientation], key=lambda x: x.start)
+        connectors = Interval.merge(connectors)
+        rind, cind = 0, 0
+        for group in groups:
+            gstart, gend = group.bsegment.start, group.bsegment.end
+
+            overlapping = []
+            while rind < len(original) and original[rind].start < gend:
+                if original[rind].end > gstart:
+                    overlapping.append(Interval(max(original[rind].start, gstart), min(original[rind].end, gend)))
+                rind += 1
 
-    result = excluding_connectors
+            while cind < len(connectors) and connectors[cind].end <= gstart:
+                cind += 1
+            if cind == len(connectors) or connectors[cind].start >= gend:
+                # No overlap with connectors
+                result.append(group)
+                continue
+
+            # Recalculate the ROIs without connectors
+            rois = Interval.merge(overlapping)
+            if rois:
+                object.__setattr__(group, 'rois', rois)
+                result.append(group)
 
     if skipped_insulators > 0:
         print(f"Skipped insulators: {skipped_insulators} ({skipped_insulators / total_insulators:.1%})")
@@ -139,3 +161,370 @@ class Partition:
         start = min(x.start for segments in allsegments for x in segments)
         end = max(x.end for segments in allsegments for x in segments)
         return Interval(start, end)
+
+
+class DisjointSet:
+    def __init__(self, size: int):
+        self._parent = list(range(size))
+
+    def find(self, node: int) -> int:
+        parent = self._parent
+        while parent[node] != node:
+            parent[node] = parent[parent[node]]
+            node = parent[node]
+        return node
+
+    def union(self, first: int, second: int) -> int:
+        first, second = self.find(first), self.find(second)
+        if first == second:
+            return first
+        # Smaller node always becomes the root to keep the components order stable
+        if first > second:
+            first, second = second, first
+        self._parent[second] = first
+        return first
+
+    def groups(self) -> list[list[int]]:
+        groups = defaultdict(list)
+        for node in range(len(self._parent)):
+            groups[self.find(node)].append(node)
+        return list(groups.values())
+
+
+def components(
+        nodes: int, elements: Iterable[tuple[int, Interval]], maxdist: int,
+        insulators: Iterable[int] | None = None, links: Iterable[Iterable[int]] = ()
+) -> list[list[int]]:
+    # Connected components of the proximity graph without materializing the N x N connection matrix:
+    # * each element is a (node, interval) pair, a single node might own several elements (e.g. dsRNA arms)
+    # * elements are connected if the gap between them is <= maxdist and there are no insulators in between
+    # * nodes within the same link are connected unconditionally
+    dsu = DisjointSet(nodes)
+    insulators = sorted(set(insulators)) if insulators else []
+
+    # Alive elements for each insulated region, i.e. min-heaps of (end, node) pairs
+    active: dict[int, list[tuple[int, int]]] = defaultdict(list)
+    for node, element in sorted(elements, key=lambda x: x[1].start):
+        threshold = element.start - maxdist
+
+        heap = active.get(bisect_left(insulators, element.start))
+        if heap:
+            # Elements that end before the threshold are too far for this and all subsequent elements
+            while heap and heap[0][0] < threshold:
+                heappop(heap)
+
+            # All other elements in the same region are connected -> collapse them into a single entry
+            if heap:
+                maxend = max(end for end, _ in heap)
+                for _, other in heap:
+                    dsu.union(node, other)
+                heap.clear()
+                heap.append((maxend, node))
+
+        heappush(active[bisect_left(insulators, element.end)], (element.end, node))
+
+    # Explicit links between nodes
+    for link in links:
+        link = iter(link)
+        anchor = next(link, None)
+        for node in link:
+            dsu.union(anchor, node)
+
+    return dsu.groups()
+
+
+class InvRepeatView(Sequence[InvRepeat]):
+    # Columnar InvRepeats: i-th InvRepeat owns segments[offsets[i]:offsets[i + 1]]
+    # Each segment is a (left start, left end, right start, right end) row
+    def __init__(
+            self, offsets: npt.NDArray[np.int64], segments: npt.NDArray[np.int64],
+            scores: npt.NDArray[np.float64] | None = None, source: tuple[Path, Hashable] | None = None
+    ):
+        assert offsets.ndim == 1 and len(offsets) >= 1 and segments.ndim == 2 and segments.shape[1] == 4
+        assert scores is None or len(scores) == len(offsets) - 1
+        self.offsets = offsets
+        self.segments = segments
+        self.scores = scores
+        self._source = source
+
+    @staticmethod
+    def from_invrep(irs: Iterable[InvRepeat], scores: Iterable[float] | None = None) -> 'InvRepeatView':
+        offsets, segments = [0], []
+        for ir in irs:
+            for segment in ir.segments:
+                segments.append((segment.left.start, segment.left.end, segment.right.start, segment.right.end))
+            offsets.append(len(segments))
+        return InvRepeatView(
+            np.asarray(offsets, dtype=np.int64), np.asarray(segments, dtype=np.int64).reshape(-1, 4),
+            np.asarray(list(scores), dtype=np.float64) if scores is not None else None
+        )
+
+    @staticmethod
+    def concat(views: Iterable['InvRepeatView']) -> 'InvRepeatView':
+        offsets, segments, scores, total = [np.zeros(1, dtype=np.int64)], [], [], 0
+        for view in views:
+            offsets.append(np.asarray(view.offsets[1:]) - view.offsets[0] + total)
+            segments.append(np.asarray(view.segments[view.offsets[0]: view.offsets[-1]]))
+            scores.append(view.scores)
+            total += view.offsets[-1] - view.offsets[0]
+
+        return InvRepeatView(
+            np.concatenate(offsets),
+            np.concatenate(segments) if segments else np.zeros((0, 4), dtype=np.int64),
+            np.concatenate(scores) if scores and all(x is not None for x in scores) else None
+        )
+
+    def arms(self) -> tuple[npt.NDArray[np.int64], ...]:
+        # Bounding ranges of left and right arms: left start/end, right start/end
+        first, last = self.offsets[:-1], self.offsets[1:] - 1
+        return self.segments[first, 0], self.segments[last, 1], self.segments[last, 2], self.segments[first, 3]
+
+    def key(self, ind: int) -> bytes:
+        return self.segments[self.offsets[ind]: self.offsets[ind + 1]].tobytes()
+
+    def take(self, inds: npt.ArrayLike) -> 'InvRepeatView':
+        inds = np.asarray(inds, dtype=np.int64)
+        starts, lengths = self.offsets[inds], self.offsets[inds + 1] - self.offsets[inds]
+
+        offsets = np.zeros(len(inds) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        rows = np.repeat(starts - offsets[:-1], lengths) + np.arange(offsets[-1])
+        scores = np.asarray(self.scores[inds]) if self.scores is not None else None
+        return InvRepeatView(offsets, np.asarray(self.segments[rows]), scores)
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def __getitem__(self, ind: int) -> InvRepeat:
+        if ind < 0:
+            ind += len(self)
+        if not 0 <= ind < len(self):
+            raise IndexError(ind)
+
+        rows = self.segments[self.offsets[ind]: self.offsets[ind + 1]].tolist()
+        return InvRepeat([InvSegment(Interval(ls, le), Interval(rs, re)) for ls, le, rs, re in rows])
+
+    def __reduce__(self):
+        # Views backed by a store are passed around as handles and memory-mapped on the other side
+        if self._source is not None:
+            return _store_view, self._source
+        return InvRepeatView, (self.offsets, self.segments, self.scores)
+
+
+class InvRepeatStore:
+    # Directory with memory-mapped columns of all InvRepeats and an index of (key -> [start, end) InvRepeats)
+    def __init__(self, root: Path):
+        self.root = root
+        with open(root / "index.pkl", 'rb') as stream:
+            self._index: dict[Hashable, tuple[int, int]] = pickle.load(stream)
+        self._offsets = np.load(root / "offsets.npy", mmap_mode='r')
+        self._segments = np.load(root / "segments.npy", mmap_mode='r')
+        self._scores = np.load(root / "scores.npy", mmap_mode='r') if (root / "scores.npy").exists() else None
+
+    @staticmethod
+    def exists(root: Path) -> bool:
+        return (root / "index.pkl").exists()
+
+    @staticmethod
+    def save(root: Path, data: Mapping[Hashable, InvRepeatView]) -> 'InvRepeatStore':
+        index, offsets, segments, scores = {}, [np.zeros(1, dtype=np.int64)], [], []
+        start, total = 0, 0
+        for key, view in data.items():
+            index[key] = (start, start + len(view))
+            start += len(view)
+
+            offsets.append(np.asarray(view.offsets[1:]) - view.offsets[0] + total)
+            segments.append(np.asarray(view.segments[view.offsets[0]: view.offsets[-1]]))
+            scores.append(view.scores)
+            total += view.offsets[-1] - view.offsets[0]
+
+        # Build the store in a temporary directory and swap it in, readers keep their memory-mapped (unlinked) files
+        root.parent.mkdir(parents=True, exist_ok=True)
+        tmp = Path(tempfile.mkdtemp(dir=root.parent, prefix=f".{root.name}."))
+        np.save(tmp / "offsets.npy", np.concatenate(offsets))
+        np.save(tmp / "segments.npy", np.concatenate(segments) if segments else np.zeros((0, 4), dtype=np.int64))
+        if scores and all(x is not None for x in scores):
+            np.save(tmp / "scores.npy", np.concatenate(scores))
+
+        # The index is saved last and marks the store as complete
+        with open(tmp / "index.pkl", 'wb') as stream:
+            pickle.dump(index, stream, protocol=pickle.HIGHEST_PROTOCOL)
+
+        _replace_dir(tmp, root)
+        return InvRepeatStore(root)
+
+    @staticmethod
+    def stream(
+            root: Path, layout: Mapping[Hashable, tuple[int, int]], chunks: Iterable[tuple[Hashable, InvRepeatView]],
+            scores: bool = True
+    ) -> 'InvRepeatStore':
+        # Write views chunk by chunk straight into memory-mapped columns. The layout declares the total number of
+        # (InvRepeats, segments) for each key, chunks of the same key are stored in the order of arrival.
+        index, cursors, irstart, segstart = {}, {}, 0, 0
+        for key, (irs, segments) in layout.items():
+            index[key] = (irstart, irstart + irs)
+            cursors[key] = [irstart, segstart]
+            irstart, segstart = irstart + irs, segstart + segments
+
+        root.parent.mkdir(parents=True, exist_ok=True)
+        tmp = Path(tempfile.mkdtemp(dir=root.parent, prefix=f".{root.name}."))
+        offsets = np.lib.format.open_memmap(tmp / "offsets.npy", mode='w+', dtype=np.int64, shape=(irstart + 1,))
+        segcol = np.lib.format.open_memmap(tmp / "segments.npy", mode='w+', dtype=np.int64, shape=(segstart, 4))
+        scorecol = np.lib.format.open_memmap(tmp / "scores.npy", mode='w+', dtype=np.float64, shape=(irstart,)) \
+            if scores else None
+
+        offsets[0] = 0
+        for key, view in chunks:
+            cursor = cursors[key]
+            irs, segments = len(view), view.offsets[-1] - view.offsets[0]
+            assert cursor[0] + irs <= index[key][1], key
+
+            offsets[cursor[0] + 1: cursor[0] + irs + 1] = np.asarray(view.offsets[1:]) - view.offsets[0] + cursor[1]
+            segcol[cursor[1]: cursor[1] + segments] = view.segments[view.offsets[0]: view.offsets[-1]]
+            if scorecol is not None:
+                scorecol[cursor[0]: cursor[0] + irs] = view.scores
+            cursor[0] += irs
+            cursor[1] += segments
+
+        assert all(cursors[key][0] == end for key, (_, end) in index.items()), "Layout doesn't match the chunks"
+        for column in offsets, segcol, scorecol:
+            if column is not None:
+                column.flush()
+        del offsets, segcol, scorecol
+
+        # The index is saved last and marks the store as complete
+        with open(tmp / "index.pkl", 'wb') as stream:
+            pickle.dump(index, stream, protocol=pickle.HIGHEST_PROTOCOL)
+        _replace_dir(tmp, root)
+        return InvRepeatStore(root)
+
+    def keys(self) -> Iterable[Hashable]:
+        return self._index.keys()
+
+    def items(self) -> Iterator[tuple[Hashable, InvRepeatView]]:
+        for key in self._index:
+            yield key, self[key]
+
+    def get(self, key: Hashable, default=None):
+        return self[key] if key in self._index else default
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._index
+
+    def __len__(self) -> int:
+        return len(self._index)
+
+    def __getitem__(self, key: Hashable) -> InvRepeatView:
+        start, end = self._index[key]
+        scores = self._scores[start:end] if self._scores is not None else None
+        return InvRepeatView(self._offsets[start: end + 1], self._segments, scores, source=(self.root, key))
+
+
+def _replace_dir(tmp: Path, root: Path):
+    # Swap a fully written directory in place of the old one (if any), stale handles of this process are dropped
+    tmp.chmod(0o755)
+    if root.exists():
+        trash = Path(tempfile.mkdtemp(dir=root.parent, prefix=f".{root.name}.old."))
+        os.replace(root, trash / root.name)
+        os.replace(tmp, root)
+        shutil.rmtree(trash)
+    else:
+        os.replace(tmp, root)
+    _open_store.cache_clear()
+
+
+# Opened stores are keyed by the index file identity, i.e. rewritten stores are reopened
+@lru_cache(maxsize=16)
+def _open_store(root: Path, version: tuple[int, int]) -> InvRepeatStore:
+    return InvRepeatStore(root)
+
+
+def _store_view(root: Path, key: Hashable) -> InvRepeatView:
+    stat = (root / "index.pkl").stat()
+    return _open_store(root, (stat.st_ino, stat.st_mtime_ns))[key]
+
+
+class PredictionCache:
+    # Content-addressed store of repeto.predict results: <root>/<digest[:2]>/<digest[2:4]>/<digest>.pkl
+    # Results are stored in the coordinates of the query sequence, i.e. they are shared by identical windows
+    def __init__(self, root: Path):
+        self.root = root
+
+    @staticmethod
+    def key(seq: bytes, rois: Iterable[tuple[int, int]], params: Mapping[str, Hashable]) -> str:
+        digest = hashlib.sha256(seq)
+        digest.update(repr([tuple(x) for x in rois]).encode())
+        digest.update(repr(sorted(params.items())).encode())
+        return digest.hexdigest()
+
+    def path(self, key: str) -> Path:
+        return self.root / key[:2] / key[2:4] / f"{key}.pkl"
+
+    def get(self, key: str) -> tuple[list[InvRepeat], list[float]] | None:
+        try:
+            with open(self.path(key), 'rb') as stream:
+                return pickle.load(stream)
+        except FileNotFoundError:
+            return None
+
+    def put(self, key: str, irs: list[InvRepeat], scores: list[float]):
+        path = self.path(key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+
+        # Atomic write, concurrent workers might compute the same window
+        fd, tmp = tempfile.mkstemp(dir=path.parent, suffix=".tmp")
+        with os.fdopen(fd, 'wb') as stream:
+            pickle.dump((irs, scores), stream, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, path)
+
+
+# 2-bit encoding of RNA bases, complement is 3 - code. Everything else (N, soft-masked leftovers, etc.) is invalid.
+_BASES = np.full(256, 255, dtype=np.uint8)
+for _code, _bases in enumerate((b"Aa", b"Cc", b"Gg", b"UuTt")):
+    _BASES[list(_bases)] = _code
+
+
+def has_seeds(seq: bytes, rois: Iterable[tuple[int, int]], k: int) -> bool:
+    # Seed-based prefilter for repeto.predict: is there a k-mer overlapping any ROI whose reverse complement occurs
+    # elsewhere in the sequence (non-overlapping)? Windows without such seeds can't contain inverted repeats with
+    # a perfectly paired stretch of at least k nt anchored in the ROIs. It's a heuristic: G-U wobble pairs and
+    # mismatches can break every such stretch of an inverted repeat that still passes the repeto filters.
+    codes = _BASES[np.frombuffer(seq, dtype=np.uint8)]
+    total = len(codes) - k + 1
+    if total <= 0:
+        return False
+
+    # Invalid k-mers contain at least one invalid base
+    invalid = np.zeros(len(codes) + 1, dtype=np.int64)
+    np.cumsum(codes == 255, out=invalid[1:])
+    valid = (invalid[k:] - invalid[:-k]) == 0
+
+    bases = codes.astype(np.int64) & 3
+    fwd, rc = np.zeros(total, dtype=np.int64), np.zeros(total, dtype=np.int64)
+    for j in range(k):
+        fwd = (fwd << 2) | bases[j: j + total]
+        rc |= (3 - bases[j: j + total]) << (2 * j)
+
+    # Leftmost/rightmost occurrence of each k-mer
+    positions = np.flatnonzero(valid)
+    order = np.argsort(fwd[positions], kind='stable')
+    kmers, positions = fwd[positions][order], positions[order]
+    if len(kmers) == 0:
+        return False
+    starts = np.flatnonzero(np.r_[True, kmers[1:] != kmers[:-1]])
+    kmers = kmers[starts]
+    leftmost, rightmost = np.minimum.reduceat(positions, starts), np.maximum.reduceat(positions, starts)
+
+    # K-mers overlapping ROIs
+    queries = np.zeros(total + 1, dtype=np.int64)
+    for start, end in rois:
+        start, end = max(0, start - k + 1), min(total, end)
+        if start < end:
+            queries[start] += 1
+            queries[end] -= 1
+    queries = np.flatnonzero((np.cumsum(queries[:-1]) > 0) & valid)
+
+    ind = np.minimum(np.searchsorted(kmers, rc[queries]), len(kmers) - 1)
+    found = kmers[ind] == rc[queries]
+    queries, ind = queries[found], ind[found]
+    return bool(np.any((leftmost[ind] <= queries - k) | (rightmost[ind] >= queries + k)))
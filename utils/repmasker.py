@@ -0,0 +1,132 @@
+from collections.abc import Sequence
+from pathlib import Path
+
+import numpy as np
+import numpy.typing as npt
+import pandas as pd
+from biobit.core.loc import Interval
+
+from . import shared
+
+REPEAT_FREE = "Repeat-free"
+
+
+# Unstranded RepeatMasker index stored as an uncompressed .npz archive:
+# * repeats of all contigs are concatenated (contig-major, sorted by start), contig c spans offsets[c]:offsets[c + 1]
+# * names are categorical (codes -> names table), strands are stored per repeat
+# * maxends is the running maximum of ends within each contig, it bounds the overlap lookups from the left
+class RepeatIndex:
+    def __init__(self, path: Path):
+        self.path = path
+        arrays = shared.npz_memmap(path)
+        self.starts, self.ends, self.maxends = arrays['starts'], arrays['ends'], arrays['maxends']
+        self.codes, self.strands = arrays['codes'], arrays['strands']
+        self.names = np.asarray(arrays['names'])
+
+        offsets = np.asarray(arrays['offsets'])
+        self.contigs = {
+            str(contig): (int(offsets[ind]), int(offsets[ind + 1])) for ind, contig in enumerate(arrays['contigs'])
+        }
+
+    @staticmethod
+    def build(repmasker: Path, saveto: Path) -> 'RepeatIndex':
+        bed = pd.read_csv(
+            repmasker, sep='\t', header=None, usecols=[0, 1, 2, 3, 5],
+            names=['contig', 'start', 'end', 'name', 'score', 'strand'],
+            dtype={'contig': str, 'start': np.int64, 'end': np.int64, 'name': str, 'strand': str}
+        )
+        assert (bed['start'] < bed['end']).all(), f"Empty repeats in {repmasker}"
+        bed = bed.sort_values(['contig', 'start', 'end'], kind='stable', ignore_index=True)
+
+        contigs, inverse = np.unique(bed['contig'].to_numpy(dtype=str), return_inverse=True)
+        offsets = np.zeros(len(contigs) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum(np.bincount(inverse, minlength=len(contigs)))
+
+        ends = bed['end'].to_numpy()
+        maxends = np.concatenate([
+            np.maximum.accumulate(ends[start:end]) for start, end in zip(offsets[:-1], offsets[1:])
+        ]) if len(bed) > 0 else ends
+
+        names = pd.Categorical(bed['name'])
+        saveto.parent.mkdir(parents=True, exist_ok=True)
+        np.savez(
+            saveto, contigs=contigs, offsets=offsets,
+            starts=bed['start'].to_numpy(dtype=np.uint32), ends=ends.astype(np.uint32),
+            maxends=maxends.astype(np.uint32), codes=names.codes.astype(np.int32),
+            names=np.asarray(names.categories, dtype=str), strands=bed['strand'].to_numpy(dtype='S1'),
+        )
+        return RepeatIndex(saveto)
+
+    def overlap(
+            self, contig: str, starts: npt.ArrayLike, ends: npt.ArrayLike
+    ) -> tuple[npt.NDArray[np.int64], npt.NDArray[np.int64]]:
+        # All (query, repeat) pairs overlapping each [start, end) range, repeats are global indices
+        starts, ends = np.asarray(starts, dtype=np.int64), np.asarray(ends, dtype=np.int64)
+        if contig not in self.contigs or len(starts) == 0:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+
+        first, last = self.contigs[contig]
+        maxends, rstarts = self.maxends[first:last], self.starts[first:last]
+        lo = first + np.searchsorted(maxends, shared.searchable(starts, maxends), side='right')
+        hi = first + np.searchsorted(rstarts, shared.searchable(ends, rstarts), side='left')
+        counts = np.maximum(hi - lo, 0)
+
+        queries = np.repeat(np.arange(len(starts)), counts)
+        repeats = np.repeat(lo - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())
+        mask = self.ends[repeats] > starts[queries]
+        return queries[mask], repeats[mask]
+
+    def dominant(self, contig: str, starts: npt.ArrayLike, ends: npt.ArrayLike) -> list[str]:
+        # Repeat name with the largest total overlap for each range, REPEAT_FREE if the uncovered part is larger
+        starts, ends = np.asarray(starts, dtype=np.int64), np.asarray(ends, dtype=np.int64)
+        queries, repeats = self.overlap(contig, starts, ends)
+        lengths = (np.minimum(self.ends[repeats], ends[queries]) -
+                   np.maximum(self.starts[repeats].astype(np.int64), starts[queries]))
+
+        # Total overlap per (query, name)
+        keys = queries * len(self.names) + self.codes[repeats]
+        keys, inverse = np.unique(keys, return_inverse=True)
+        weights = np.bincount(inverse, weights=lengths, minlength=len(keys))
+        queries, codes = np.divmod(keys, len(self.names))
+
+        # Keys are sorted by query: the best name is the first maximum within each query block
+        order = np.lexsort((-weights, queries))
+        queries, codes, weights = queries[order], codes[order], weights[order]
+        first = np.ones(len(queries), dtype=bool)
+        first[1:] = queries[1:] != queries[:-1]
+
+        bestw = np.zeros(len(starts), dtype=np.float64)
+        bestc = np.full(len(starts), -1, dtype=np.int64)
+        bestw[queries[first]], bestc[queries[first]] = weights[first], codes[first]
+
+        free = (ends - starts) - np.bincount(queries, weights=weights, minlength=len(starts))
+        return [
+            REPEAT_FREE if code < 0 or free > weight else str(self.names[code])
+            for code, weight, free in zip(bestc, bestw, free)
+        ]
+
+    def steps(
+            self, contig: str, ranges: Sequence[Interval]
+    ) -> list[list[tuple[Interval, set[tuple[str, str]]]]]:
+        # Step annotation of each range: consecutive segments covering the range with the set of overlapping
+        # (name, strand) repeats. Segments without repeats have an empty set.
+        starts = np.asarray([x.start for x in ranges], dtype=np.int64)
+        ends = np.asarray([x.end for x in ranges], dtype=np.int64)
+        queries, repeats = self.overlap(contig, starts, ends)
+        bounds = np.searchsorted(queries, np.arange(len(ranges) + 1))
+
+        results = []
+        for ind, (start, end) in enumerate(zip(starts, ends)):
+            rps = repeats[bounds[ind]:bounds[ind + 1]]
+            rstarts = np.maximum(self.starts[rps].astype(np.int64), start)
+            rends = np.minimum(self.ends[rps].astype(np.int64), end)
+
+            points = np.unique(np.concatenate([[start, end], rstarts, rends]))
+            covered = (rstarts[None, :] <= points[:-1, None]) & (rends[None, :] >= points[1:, None])
+            annotation = [(str(self.names[c]), s.decode()) for c, s in zip(self.codes[rps], self.strands[rps])]
+
+            results.append([
+                (Interval(int(left), int(right)), {annotation[x] for x in np.flatnonzero(mask)})
+                for left, right, mask in zip(points[:-1], points[1:], covered)
+            ])
+        return results
@@ -0,0 +1,116 @@
+import shutil
+import tempfile
+import zipfile
+from collections import OrderedDict
+from dataclasses import dataclass
+from pathlib import Path
+
+import numpy as np
+import numpy.typing as npt
+
+# Shared data plane for worker pools: arrays are published once as memory-mapped .npy files (in RAM-backed /dev/shm
+# when available) and only lightweight handles are pickled into tasks. All workers share the same physical pages.
+SHM = Path("/dev/shm")
+# Free space to keep in the plane's file system, otherwise arrays are spilled to the regular temporary directory
+SPILL_RESERVE = 1024 ** 3
+
+
+@dataclass(frozen=True, slots=True)
+class Handle:
+    path: Path
+
+    def load(self) -> dict[str, npt.NDArray]:
+        return _load(self.path)
+
+
+# Memory maps opened by this process (LRU). Long-lived workers drop the maps of closed (deleted) planes as soon as
+# they see a handle from another plane, i.e. /dev/shm pages of old planes aren't pinned between tasks.
+_MAPPED: OrderedDict[Path, dict[str, npt.NDArray]] = OrderedDict()
+_MAPPED_MAX = 1024
+
+
+def _load(path: Path) -> dict[str, npt.NDArray]:
+    if path in _MAPPED:
+        _MAPPED.move_to_end(path)
+        return _MAPPED[path]
+
+    if _MAPPED and next(reversed(_MAPPED)).parent != path.parent:
+        _evict(lambda x: not x.parent.exists())
+    arrays = {x.stem: np.load(x, mmap_mode='r') for x in sorted(path.glob("*.npy"))}
+    _MAPPED[path] = arrays
+    while len(_MAPPED) > _MAPPED_MAX:
+        _MAPPED.popitem(last=False)
+    return arrays
+
+
+def _evict(predicate):
+    for path in [x for x in _MAPPED if predicate(x)]:
+        del _MAPPED[path]
+
+
+class Plane:
+    def __init__(self, root: Path | None = None):
+        if root is None and SHM.is_dir():
+            root = SHM
+        self.root = Path(tempfile.mkdtemp(prefix="zdott-plane-", dir=root))
+        self._spill: Path | None = None
+        self._published = 0
+
+    def publish(self, **arrays: npt.ArrayLike) -> Handle:
+        arrays = {name: np.ascontiguousarray(array) for name, array in arrays.items()}
+
+        # Fall back to the regular temporary directory when the RAM-backed one is running out of space
+        root = self.root
+        if shutil.disk_usage(root).free < SPILL_RESERVE + sum(x.nbytes for x in arrays.values()):
+            if self._spill is None:
+                self._spill = Path(tempfile.mkdtemp(prefix="zdott-plane-"))
+            root = self._spill
+
+        path = root / str(self._published)
+        path.mkdir()
+        self._published += 1
+
+        for name, array in arrays.items():
+            np.save(path / f"{name}.npy", array)
+        return Handle(path)
+
+    def close(self):
+        roots = [self.root] if self._spill is None else [self.root, self._spill]
+        _evict(lambda x: x.parent in roots)
+        for root in roots:
+            shutil.rmtree(root, ignore_errors=True)
+
+    def __enter__(self) -> 'Plane':
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+
+def npz_memmap(path: Path) -> dict[str, npt.NDArray]:
+    # np.load doesn't memory-map .npz members, map the stored (uncompressed) .npy payloads directly
+    result = {}
+    with zipfile.ZipFile(path) as archive, open(path, 'rb') as stream:
+        for info in archive.infolist():
+            assert info.compress_type == zipfile.ZIP_STORED, f"Compressed archives can't be memory-mapped: {path}"
+
+            # Local file header: 30 fixed bytes + file name + extra field
+            stream.seek(info.header_offset + 26)
+            namelen, extralen = np.frombuffer(stream.read(4), dtype='<u2')
+            stream.seek(info.header_offset + 30 + namelen + extralen)
+
+            if np.lib.format.read_magic(stream) == (1, 0):
+                shape, fortran, dtype = np.lib.format.read_array_header_1_0(stream)
+            else:
+                shape, fortran, dtype = np.lib.format.read_array_header_2_0(stream)
+            result[info.filename.removesuffix(".npy")] = np.memmap(
+                path, dtype=dtype, mode='r', offset=stream.tell(), shape=shape, order='F' if fortran else 'C'
+            ) if np.prod(shape) > 0 else np.zeros(shape, dtype=dtype)
+    return result
+
+
+def searchable(values: npt.ArrayLike, index: npt.NDArray) -> npt.NDArray:
+    # Cast integer queries to the dtype of a sorted index, clipping out-of-range values. np.searchsorted would
+    # otherwise cast the whole (memory-mapped) index to the common dtype on every call.
+    info = np.iinfo(index.dtype)
+    return np.clip(np.asarray(values, dtype=np.int64), info.min, info.max).astype(index.dtype)
@@ -0,0 +1,49 @@
+from collections.abc import Iterable
+from pathlib import Path
+
+import numpy as np
+import numpy.typing as npt
+import pandas as pd
+
+from . import shared
+
+
+# Position index of single-nucleotide sites (e.g. A-to-I editing sites) stored as an uncompressed .npz archive.
+# Each member is a sorted array of unique uint32 positions for a single (contig, strand) pair.
+class SiteIndex:
+    def __init__(self, path: Path):
+        self.path = path
+        self._positions = shared.npz_memmap(path)
+
+    @staticmethod
+    def build(beds: Iterable[Path], saveto: Path) -> 'SiteIndex':
+        positions = {}
+        for path in beds:
+            bed = pd.read_csv(path, sep='\t', header=None, usecols=[0, 1, 2, 5], dtype={0: str, 1: int, 2: int, 5: str})
+            assert ((bed[2] - bed[1]) == 1).all(), f"Only single-nucleotide sites are supported: {path}"
+            for (contig, strand), sites in bed.groupby([0, 5], sort=False):
+                positions.setdefault(_key(contig, strand), []).append(sites[1].to_numpy(dtype=np.uint32))
+
+        saveto.parent.mkdir(parents=True, exist_ok=True)
+        np.savez(saveto, **{key: np.unique(np.concatenate(arrays)) for key, arrays in positions.items()})
+        return SiteIndex(saveto)
+
+    def positions(self, contig: str, strand: str) -> npt.NDArray[np.uint32]:
+        return self._positions.get(_key(contig, strand), np.zeros(0, dtype=np.uint32))
+
+    def count(
+            self, contig: str, strand: str, starts: npt.ArrayLike, ends: npt.ArrayLike
+    ) -> npt.NDArray[np.int64]:
+        # Number of sites within each [start, end) range
+        positions = self.positions(contig, strand)
+        starts, ends = shared.searchable(starts, positions), shared.searchable(ends, positions)
+        return np.searchsorted(positions, ends, side='left') - np.searchsorted(positions, starts, side='left')
+
+    def fetch(self, contig: str, strand: str, start: int, end: int) -> npt.NDArray[np.uint32]:
+        positions = self.positions(contig, strand)
+        lo, hi = np.searchsorted(positions, shared.searchable([start, end], positions), side='left')
+        return positions[lo:hi]
+
+
+def _key(contig: str, strand: str) -> str:
+    return f"{contig}|{strand}"